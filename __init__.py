@@ -1,4 +1,10 @@
+import time
+
+_import_started = time.perf_counter()
+
+import hashlib
 import importlib
+import importlib.metadata
 import os
 import sys
 import folder_paths
@@ -18,31 +24,75 @@ NODE_DISPLAY_NAME_MAPPINGS = {}
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Records a successful dependency check; delete it to force a recheck
+stamp_file = os.path.join(nodefolder, ".deps_stamp")
+
+
+def requirement_names(text):
+    names = []
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line or line.startswith("-"):
+            continue
+        name = re.split(r"[\s<>=!~;\[]", line, maxsplit=1)[0]
+        # Some entries (asyncio) are stdlib modules, which have no installed distribution
+        if name and name not in getattr(sys, "stdlib_module_names", ("asyncio",)):
+            names.append(name)
+    return names
+
+
+def is_installed(name):
+    try:
+        importlib.metadata.distribution(name)
+        return True
+    except importlib.metadata.PackageNotFoundError:
+        return False
+
+
 def install_dependencies():
     req_file = os.path.join(nodefolder, "requirements.txt")
     if not os.path.exists(req_file):
         logging.warning(f"Requirements file not found: {req_file}")
         return
 
-    with open(req_file) as f:
-        required = [re.split(r'[<>=]', line.strip())[0] for line in f if line.strip()]
+    with open(req_file, "rb") as f:
+        requirements = f.read()
 
-    installed = subprocess.check_output([sys.executable, '-m', 'pip', 'freeze']).decode().splitlines()
-    installed = [pkg.split('==')[0].lower() for pkg in installed]
-
-    missing = [pkg for pkg in required if pkg.lower() not in installed]
-    if not missing:
+    # Nothing to check while requirements.txt and the interpreter are the ones last checked
+    stamp = hashlib.sha256(requirements + sys.executable.encode() + sys.version.encode()).hexdigest()
+    try:
+        with open(stamp_file, encoding="utf-8") as f:
+            if f.read().strip() == stamp:
+                return
+    except OSError:
+        pass
+
+    missing = [name for name in requirement_names(requirements.decode("utf-8", "replace")) if not is_installed(name)]
+    if missing:
+        logging.info(f"Installing missing packages: {', '.join(missing)}")
+        try:
+            subprocess.check_call([sys.executable, '-m', 'pip', 'install', *missing])
+            logging.info("Packages installed successfully")
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Installation failed: {e}")
+            return
+        importlib.invalidate_caches()
+    else:
         logging.info("All dependencies are already installed")
-        return
 
-    logging.info(f"Installing missing packages: {', '.join(missing)}")
     try:
-        subprocess.check_call([sys.executable, '-m', 'pip', 'install', *missing])
-        logging.info("Packages installed successfully")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Installation failed: {e}")
+        with open(stamp_file, "w", encoding="utf-8") as f:
+            f.write(stamp)
+    except OSError as e:
+        logging.warning(f"Could not write {stamp_file}: {e}")
+
 
 install_dependencies()
+dependencies_checked = time.perf_counter()
+
+# Nodes read ingested layers from the backend store, so it must be importable first
+if backend_path not in sys.path:
+    sys.path.append(backend_path)
 
 for module_name in node_list:
     spec = importlib.util.spec_from_file_location(module_name, os.path.join(nodes, f"{module_name}.py"))
@@ -51,9 +101,6 @@ for module_name in node_list:
     NODE_CLASS_MAPPINGS.update(imported_module.NODE_CLASS_MAPPINGS)
     NODE_DISPLAY_NAME_MAPPINGS.update(imported_module.NODE_DISPLAY_NAME_MAPPINGS)
 
-if backend_path not in sys.path:
-    sys.path.append(backend_path)
-
 
 def load_module(module_name, file_path):
     spec = importlib.util.spec_from_file_location(module_name, os.path.join(backend_path, file_path))
@@ -66,5 +113,11 @@ def load_module(module_name, file_path):
 server_module_1 = load_module("BluePixelServer", "BPserver.py")
 server_module_2 = load_module("BluePixelRoutes", "BProute.py")
 
+from BPmetrics import stage_seconds
+
+stage_seconds.observe(dependencies_checked - _import_started, "dependency_check")
+stage_seconds.observe(time.perf_counter() - _import_started, "package_import")
+logging.info(f"BluePixel loaded in {time.perf_counter() - _import_started:.2f}s (dependency check {dependencies_checked - _import_started:.2f}s)")
+
 __all__ = ["NODE_CLASS_MAPPINGS", "NODE_DISPLAY_NAME_MAPPINGS"]
 WEB_DIRECTORY = "js"
@@ -0,0 +1,150 @@
+"""Delivery cost of `render_batch` messages: msgpack bin vs. int lists.
+
+Each case sends one batch through `WebSocketManager.send_render_batch` to a
+stub Photoshop client, using the same ComfyUI stand-ins as `bench_suite.py`.
+A client that advertises "bin" gets the PNG bytes as msgpack bin. One that
+does not gets the legacy int-list conversion. The time runs from the call
+until the client's outbox writer has handed the packed frame to the
+socket.
+
+Each case runs in a fresh process so its peak RSS is not polluted by the
+previous one. PNG bytes are simulated with random data sized at
+`--png-ratio` of the raw RGB frame, which is close to what real renders
+compress to. Every size and count pair is run and reported; a case whose
+process dies (e.g. out of memory) is reported with its exit code.
+
+    python benchmarks/bench_render_batch.py
+    python benchmarks/bench_render_batch.py --sizes 1024 --counts 1 4 --json out.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import bench_suite
+
+
+def _reset_peak_rss():
+    # Linux only: restart the VmHWM high-water mark from the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class _CountingSocket(bench_suite._SinkSocket):
+    """Sink that records the frame the outbox writer sends."""
+
+    def __init__(self):
+        self.sent_bytes = 0
+        self.sent = asyncio.Event()
+
+    async def send_bytes(self, data):
+        self.sent_bytes += len(data)
+        self.sent.set()
+
+
+async def _deliver(encoding, size, count, png_ratio):
+    from BPclient import Client, ws_manager
+
+    payload_bytes = int(size * size * 3 * png_ratio)
+    bounds = {"left": 0, "top": 0, "right": size, "bottom": size}
+    # Shaped like `encode_render` results
+    batch = [{"image": os.urandom(payload_bytes), "size": {"width": size, "height": size}, "sourceBounds": bounds, "filename": f"render_{index}.png", "cropped": False} for index in range(count)]
+
+    socket = _CountingSocket()
+    features = frozenset({"bin"}) if encoding == "bin" else frozenset()
+    ws_manager.connect(Client(id="bench-ps", ws=socket, platform="ps", ip="127.0.0.1", features=features, pair_key=("key", "bench")))
+    try:
+        _reset_peak_rss()
+        baseline_mb = _rss_mb()
+        start = time.perf_counter()
+        await ws_manager.send_render_batch(["bench-ps"], batch, start)
+        await socket.sent.wait()
+        elapsed = time.perf_counter() - start
+        peak_mb = _rss_mb()
+    finally:
+        await ws_manager.handle_client_disconnect("bench-ps", "ps")
+
+    return {
+        "encoding": encoding,
+        "size": size,
+        "count": count,
+        "payload_mb": round(payload_bytes * count / 2**20, 1),
+        "packed_mb": round(socket.sent_bytes / 2**20, 1),
+        "seconds": round(elapsed, 4),
+        "baseline_rss_mb": baseline_mb and round(baseline_mb, 1),
+        "peak_rss_mb": peak_mb and round(peak_mb, 1),
+    }
+
+
+def _run_case(encoding, size, count, png_ratio, results):
+    bench_suite._install_comfy_stubs(tempfile.mkdtemp(prefix="bp-render-batch-"))
+    sys.path.insert(0, os.path.join(bench_suite.ROOT, "py", "backend"))
+    results.put(asyncio.run(_deliver(encoding, size, count, png_ratio)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 4096])
+    parser.add_argument("--counts", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--png-ratio", type=float, default=0.5)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    for size in args.sizes:
+        for count in args.counts:
+            for encoding in ("bin", "list"):
+                results = context.Queue()
+                process = context.Process(target=_run_case, args=(encoding, size, count, args.png_ratio, results))
+                process.start()
+                process.join()
+                try:
+                    rows.append(results.get(timeout=1))
+                except queue.Empty:
+                    payload_mb = size * size * 3 * args.png_ratio * count / 2**20
+                    rows.append({"encoding": encoding, "size": size, "count": count, "payload_mb": round(payload_mb, 1), "exit_code": process.exitcode})
+
+    print(f"{'enc':<5}{'size':>6}{'n':>4}{'payload MB':>12}{'packed MB':>11}{'seconds':>10}{'base RSS':>10}{'peak RSS':>10}")
+    for row in rows:
+        if "exit_code" in row:
+            print(f"{row['encoding']:<5}{row['size']:>6}{row['count']:>4}{row['payload_mb']:>12}   failed (exit code {row['exit_code']})")
+            continue
+        print(f"{row['encoding']:<5}{row['size']:>6}{row['count']:>4}{row['payload_mb']:>12}{row['packed_mb']:>11}{row['seconds']:>10}{str(row['baseline_rss_mb']):>10}{str(row['peak_rss_mb']):>10}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(rows, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+"""Headless benchmarks for the ingest and render paths.
+
+ComfyUI's `folder_paths`, `server` and `nodes` modules are replaced by small
+stand-ins, so the backend and node code runs without a ComfyUI checkout;
+everything else (numpy, Pillow, msgpack, aiohttp, aiofiles and, for the
+node cases, torch) must be installed. Every case runs over a matrix of
+square resolutions and batch sizes and reports the median and minimum of
+`--repeat` runs.
+
+    python benchmarks/bench_suite.py --json baseline.json
+    python benchmarks/bench_suite.py --sizes 1024 --batches 1 --compare baseline.json
+
+With `--compare`, cases slower than the baseline by more than
+`--threshold` are flagged and the exit status is 1.
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import importlib.util
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _install_comfy_stubs(base: str) -> None:
+    """Stand-ins for the ComfyUI modules the package imports."""
+    custom_nodes = os.path.join(base, "custom_nodes")
+    temp_dir = os.path.join(base, "temp")
+    os.makedirs(os.path.join(custom_nodes, "comfyui-photoshop", "data", "ps_inputs", "imgs"), exist_ok=True)
+    os.makedirs(temp_dir, exist_ok=True)
+
+    folder_paths = types.ModuleType("folder_paths")
+    folder_paths.get_folder_paths = lambda name: [custom_nodes]
+    folder_paths.get_temp_directory = lambda: temp_dir
+
+    def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height=0):
+        return output_dir, filename_prefix, 1, "", filename_prefix
+
+    folder_paths.get_save_image_path = get_save_image_path
+    sys.modules["folder_paths"] = folder_paths
+
+    from aiohttp import web
+
+    server = types.ModuleType("server")
+    app = web.Application()
+    server.PromptServer = types.SimpleNamespace(instance=types.SimpleNamespace(routes=web.RouteTableDef(), app=app, address="127.0.0.1", port=0, loop=None))
+    sys.modules["server"] = server
+
+    nodes = types.ModuleType("nodes")
+
+    class SaveImage:
+        # Mirrors ComfyUI's SaveImage.save_images closely enough to time it
+        def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
+            filename_prefix += self.prefix_append
+            full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir)
+            results = []
+            for batch_number, image in enumerate(images):
+                array = 255.0 * image.cpu().numpy()
+                img = Image.fromarray(np.clip(array, 0, 255).astype(np.uint8))
+                file = f"{filename}_{batch_number:05}_{counter:05}_.png"
+                img.save(os.path.join(full_output_folder, file), compress_level=self.compress_level)
+                results.append({"filename": file, "subfolder": subfolder, "type": self.type})
+            return {"ui": {"images": results}}
+
+    nodes.SaveImage = SaveImage
+    sys.modules["nodes"] = nodes
+
+
+def _load_node_module(name: str):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, "py", "nodes", f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class _SinkSocket:
+    closed = False
+
+    async def send_bytes(self, data):
+        pass
+
+    async def send_str(self, data):
+        pass
+
+
+_server_loop = None
+
+
+def _bind_server_loop():
+    """Run an event loop in the background as ComfyUI's server loop, with two sink PS clients.
+
+    Nodes hand renders to that loop from their own thread; one client takes
+    full frames and one advertises "crop", so both encode paths run.
+    """
+    global _server_loop
+    from BPclient import Client, ws_manager
+
+    if _server_loop is None:
+        _server_loop = asyncio.new_event_loop()
+        threading.Thread(target=_server_loop.run_forever, name="bench-server-loop", daemon=True).start()
+        ws_manager.loop = _server_loop
+
+        async def connect():
+            for client_id, features in (("bench-ps-full", {"bin"}), ("bench-ps-crop", {"bin", "crop"})):
+                ws_manager.connect(Client(id=client_id, ws=_SinkSocket(), platform="ps", ip="127.0.0.1", features=frozenset(features), pair_key=("key", "bench")))
+
+        asyncio.run_coroutine_threadsafe(connect(), _server_loop).result()
+    return _server_loop
+
+
+def _stop_server_loop():
+    from BPclient import ws_manager
+
+    if _server_loop is None:
+        return
+
+    async def disconnect():
+        for client in ws_manager.registry.clients():
+            await ws_manager.handle_client_disconnect(client.id, client.platform)
+
+    asyncio.run_coroutine_threadsafe(disconnect(), _server_loop).result()
+    _server_loop.call_soon_threadsafe(_server_loop.stop)
+
+
+def _layer(size: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    # Smooth gradients plus noise compress roughly like real artwork
+    ramp = np.linspace(0, 255, size, dtype=np.float32)
+    pixels = (ramp[None, :, None] * 0.5 + ramp[:, None, None] * 0.5 + rng.normal(0, 12, (size, size, 4))).clip(0, 255).astype(np.uint8)
+    pixels[..., 3] = 255
+    pixels[: size // 8, :, 3] = 0
+    return pixels
+
+
+def _raw_info(pixels: np.ndarray, resized: bool) -> dict:
+    height, width = pixels.shape[:2]
+    if resized:
+        # The layer is scaled into the part of the document its bounds cover
+        bounds = {"left": width // 8, "top": height // 8, "right": width - width // 8, "bottom": height - height // 8}
+    else:
+        bounds = {"left": 0, "top": 0, "right": width, "bottom": height}
+    return {"width": width, "height": height, "imageData": pixels.tobytes(), "sourceBounds": bounds}
+
+
+# Each case takes (size, batch) and returns a zero-argument callable to time
+def case_ingest_raw_full(size, batch):
+    from BPclient import process_changed_images
+
+    images = [{"title": f"raw_{index}", "imageInfo": _raw_info(_layer(size, index), False)} for index in range(batch)]
+    return lambda: asyncio.run(process_changed_images(images))
+
+
+def case_ingest_raw_resized(size, batch):
+    from BPclient import process_changed_images
+
+    images = [{"title": f"resized_{index}", "imageInfo": _raw_info(_layer(size, index), True)} for index in range(batch)]
+    return lambda: asyncio.run(process_changed_images(images))
+
+
+def case_ingest_jpeg(size, batch):
+    from BPclient import process_changed_images
+
+    images = []
+    for index in range(batch):
+        buffer = io.BytesIO()
+        Image.fromarray(_layer(size, index)[..., :3]).save(buffer, format="JPEG", quality=90)
+        images.append({"title": f"jpeg_{index}", "imageInfo": base64.b64encode(buffer.getvalue()).decode()})
+    return lambda: asyncio.run(process_changed_images(images))
+
+
+def case_mask(size, batch):
+    from BPclient import process_and_save_mask
+
+    inset = size // 8
+    # The mask is scaled into the document minus the `sourcebounds` padding
+    mask = {"maskData": _layer(size)[..., 0].tobytes(), "width": size, "height": size, "sourcebounds": {"left": inset, "top": inset, "right": inset, "bottom": inset}}
+
+    async def run():
+        for _ in range(batch):
+            await process_and_save_mask(mask, "SELECTION.png")
+
+    return lambda: asyncio.run(run())
+
+
+def case_select_image(size, batch):
+    from BPstore import layer_store
+
+    node_other = _load_node_module("nodeOther")
+    for index in range(batch):
+        layer_store.put(f"select_{index}", _layer(size, index))
+    layer_store.put("SELECTION", _layer(size)[..., 0])
+    node = node_other.PsImages()
+
+    def run():
+        # Time the conversion, not a lookup in the node's tensor cache
+        node_other.tensor_cache.clear()
+        for index in range(batch):
+            node.select_image(f"select_{index}")
+
+    return run
+
+
+def case_select_image_png(size, batch):
+    node_other = _load_node_module("nodeOther")
+    for index in range(batch):
+        # Not in the layer store, so the node decodes the PNG frame path
+        Image.fromarray(_layer(size, index)).save(os.path.join(node_other.imgpath, f"png_{index}.png"), compress_level=1)
+    node = node_other.PsImages()
+
+    def run():
+        node_other.tensor_cache.clear()
+        for index in range(batch):
+            node.select_image(f"png_{index}")
+
+    return run
+
+
+def case_execute_alpha(size, batch):
+    import torch
+    from BPclient import ws_manager
+
+    _bind_server_loop()
+    node_plugin = _load_node_module("nodePlugin")
+    rgb = torch.from_numpy(_layer(size)[..., :3].astype(np.float32) / 255.0).unsqueeze(0).repeat(batch, 1, 1, 1)
+    # Masks at half resolution exercise the interpolate path
+    alpha = torch.from_numpy(_layer(size // 2)[..., 0].astype(np.float32) / 255.0).unsqueeze(0)
+    node = node_plugin.ComfyUIToPhotoshop()
+    deliveries = []
+    deliver = ws_manager.deliver_pixels_threadsafe
+
+    def tracked(*args):
+        deliveries.append(deliver(*args))
+        return deliveries[-1]
+
+    ws_manager.deliver_pixels_threadsafe = tracked
+
+    def run():
+        node.execute(rgb, alpha)
+        if not deliveries:
+            raise RuntimeError("execute did not hand its renders to the server loop")
+        # Include the encode and send the node hands off, so runs never overlap
+        deliveries.pop().result()
+
+    return run
+
+
+def case_deliver_pixels(size, batch):
+    from BPclient import ws_manager
+
+    loop = _bind_server_loop()
+    renders = []
+    for index in range(batch):
+        pixels = _layer(size, index)
+        # The transparent top eighth gives crop-capable clients a smaller region
+        renders.append((pixels, {"left": 0, "top": size // 8, "right": size, "bottom": size}, f"render_{index}.png"))
+    return lambda: asyncio.run_coroutine_threadsafe(ws_manager.deliver_pixels("", renders), loop).result()
+
+
+def case_render_batch(size, batch):
+    import folder_paths
+    from aiohttp.test_utils import make_mocked_request
+
+    import BProute
+
+    loop = _bind_server_loop()
+
+    filenames = []
+    for index in range(batch):
+        filename = f"bench_render_{size}_{index}.png"
+        Image.fromarray(_layer(size, index)).save(os.path.join(folder_paths.get_temp_directory(), filename), compress_level=4)
+        filenames.append(filename)
+
+    async def run():
+        await BProute.handle_render_batch(make_mocked_request("GET", f"/ps/renderbatch?filenames={','.join(filenames)}"))
+
+    return lambda: asyncio.run_coroutine_threadsafe(run(), loop).result()
+
+
+CASES = {
+    "ingest_raw_full": case_ingest_raw_full,
+    "ingest_raw_resized": case_ingest_raw_resized,
+    "ingest_jpeg": case_ingest_jpeg,
+    "mask": case_mask,
+    "select_image": case_select_image,
+    "select_image_png": case_select_image_png,
+    "execute_alpha": case_execute_alpha,
+    "deliver_pixels": case_deliver_pixels,
+    "render_batch": case_render_batch,
+}
+
+
+def run_case(name, size, batch, repeat):
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run = CASES[name](size, batch)
+            # One untimed run warms caches, thread pools and lazy imports
+            run()
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - start)
+    except ImportError as e:
+        return {"case": name, "size": size, "batch": batch, "skipped": f"missing dependency: {e.name}"}
+    return {"case": name, "size": size, "batch": batch, "median": round(statistics.median(timings), 5), "min": round(min(timings), 5), "repeat": repeat}
+
+
+def compare(rows, baseline_rows, threshold):
+    baseline = {(row["case"], row["size"], row["batch"]): row for row in baseline_rows if "median" in row}
+    regressions = []
+    for row in rows:
+        before = baseline.get((row["case"], row["size"], row["batch"]))
+        if before is None or "median" not in row:
+            continue
+        row["baseline"] = before["median"]
+        row["ratio"] = round(row["median"] / before["median"], 3) if before["median"] else None
+        if row["ratio"] is not None and row["ratio"] > 1 + threshold:
+            row["regression"] = True
+            regressions.append(row)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048])
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--cases", nargs="+", choices=sorted(CASES), default=list(CASES))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline JSON from an earlier --json run")
+    parser.add_argument("--threshold", type=float, default=0.15, help="flag cases slower than the baseline by more than this fraction")
+    args = parser.parse_args()
+
+    # Background persistence would compete with the timed work; opt back in via the environment
+    os.environ.setdefault("BLUEPIXEL_PERSIST_LAYERS", "0")
+    logging.disable(logging.INFO)
+    base = tempfile.mkdtemp(prefix="bluepixel-bench-")
+    _install_comfy_stubs(base)
+    sys.path.insert(0, os.path.join(ROOT, "py", "backend"))
+
+    rows = [run_case(name, size, batch, args.repeat) for name in args.cases for size in args.sizes for batch in args.batches]
+    _stop_server_loop()
+
+    regressions = []
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            regressions = compare(rows, json.load(file)["results"], args.threshold)
+
+    print(f"{'case':<20}{'size':>6}{'n':>4}{'median s':>11}{'min s':>10}{'baseline':>10}{'ratio':>8}")
+    for row in rows:
+        if "skipped" in row:
+            print(f"{row['case']:<20}{row['size']:>6}{row['batch']:>4}   skipped ({row['skipped']})")
+            continue
+        flag = "  REGRESSION" if row.get("regression") else ""
+        print(f"{row['case']:<20}{row['size']:>6}{row['batch']:>4}{row['median']:>11}{row['min']:>10}{str(row.get('baseline', '-')):>10}{str(row.get('ratio', '-')):>8}{flag}")
+
+    if args.json:
+        meta = {"python": platform.python_version(), "platform": platform.platform(), "numpy": np.__version__, "pillow": Image.__version__, "cpus": os.cpu_count()}
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({"meta": meta, "results": rows}, file, indent=2)
+
+    if regressions:
+        print(f"\n{len(regressions)} case(s) regressed by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
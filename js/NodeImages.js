@@ -2,12 +2,23 @@ import { getTitleInfoMap, manageNameList } from "./TitleManager.js";
 import { bgImg, sendList } from "./utils.js";
 import { api } from "../../../scripts/api.js";
 import e from "./event.js";
+import { clinetid } from "./connection.js";
 
 const NodeID = "🔹Photoshop Images";
 let thisNode = [];
 const msgType = "ImageSlots";
 const DefaultName = "MAIN DOC";
 
+// Routes the node to this tab's Photoshop layers when several artists share the server;
+// saved workflows carry another tab's id, so it is reset after every load
+const setClientId = (node) => {
+  const uidWidget = node.widgets.find((w) => w.name === "cmUID");
+  if (!uidWidget) return;
+  uidWidget.value = clinetid;
+  uidWidget.computeSize = () => [0, -4];
+  uidWidget.type = "hidden";
+};
+
 async function styleIt(node) {
   const stringWidget = node.widgets[0];
   node.computeSize = () => [120, 120];
@@ -21,12 +32,14 @@ async function styleIt(node) {
   stringWidget.computeSize = () => [0, -12];
   stringWidget.type = "hidden";
 
+  setClientId(node);
+
   api.addEventListener("execution_start", () => previewOnTheNode(node));
   const previewOnTheNode = async (node) => {
     try {
       // Check if images exist before setting them on the node
-      const imagePath = `/ps/inputs/${stringWidget.value}.png?v=${Date.now()}`;
-      const selectionPath = `/ps/inputs/SELECTION.png?v=${Date.now()}`;
+      const imagePath = `/ps/inputs/${stringWidget.value}.png?cmUID=${clinetid}&v=${Date.now()}`;
+      const selectionPath = `/ps/inputs/SELECTION.png?cmUID=${clinetid}&v=${Date.now()}`;
       
       // Use fetch with Promise.all to check if images exist
       const imgPromise = fetch('/api' + imagePath, { method: 'HEAD' })
@@ -113,6 +126,9 @@ e.on("beforeRegister", (node, nodeData, app) => {
   }
 });
 
-e.on("afterWorkflowLoaded", async () => await send());
+e.on("afterWorkflowLoaded", async () => {
+  thisNode.forEach((node) => setClientId(node));
+  await send();
+});
 e.on("psConnected", async () => await send());
 const send = async () => await sendList(msgType, await getTitleInfoMap(msgType), DefaultName);
@@ -0,0 +1,78 @@
+"""Byte-bounded in-memory caches, with hits, misses and size exported as metrics."""
+
+import threading
+from collections import OrderedDict
+
+from BPmetrics import metrics
+
+_caches: list["LRUCache"] = []
+
+cache_events = metrics.counter("bluepixel_cache_events_total", "Lookups and evictions in in-memory result caches.", ("cache", "event"))
+metrics.gauge("bluepixel_cache_bytes", "Bytes held by in-memory result caches.", ("cache",), collect=lambda: {(cache.name,): cache._bytes for cache in _caches})
+
+
+def cache_stats() -> dict:
+    """Per-cache occupancy and hit counts, keyed by cache name."""
+    return {cache.name: cache.stats() for cache in _caches}
+
+
+class LRUCache:
+    """Least-recently-used cache bounded by the total size of its values.
+
+    Keys must change whenever the underlying data does (e.g. include a
+    content digest), so entries never need invalidating. Values are shared
+    between callers and must not be modified in place.
+    """
+
+    def __init__(self, name: str, budget_bytes: int, sizeof):
+        self.name = name
+        self.budget_bytes = max(0, budget_bytes)
+        self._sizeof = sizeof
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        _caches.append(self)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        cache_events.inc(1, self.name, "miss" if entry is None else "hit")
+        return None if entry is None else entry[0]
+
+    def put(self, key, value) -> bool:
+        """Store `value`, evicting older entries; False if it alone exceeds the budget."""
+        size = self._sizeof(value)
+        if size > self.budget_bytes:
+            # Caching it would evict everything else for a single entry
+            return False
+        evicted = 0
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.budget_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+                evicted += 1
+            self.evictions += evicted
+        if evicted:
+            cache_events.inc(evicted, self.name, "eviction")
+        return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "budget_bytes": self.budget_bytes, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
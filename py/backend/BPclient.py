@@ -1,311 +1,703 @@
-import base64
+import concurrent.futures
 import io
 import json
 import logging
+import threading
+from collections import OrderedDict, deque
 from dataclasses import dataclass
 import os
-from aiohttp import web
+from aiohttp import web, WSCloseCode
 import numpy as np
 import msgpack
-from BPutils import force_pull, install_plugin, dirs
+from BPutils import force_pull, install_plugin, settings
+from BPstore import LayerStore, layer_store, layer_stores
+from BPcodec import encode, png_header
+from BPimage import ResamplePolicy, as_uint8, decode_mask, ingest_path
+from BPworkers import IngestPool
+from BPupload import UploadError, UploadManager
+from BPmetrics import bytes_sent, message_bytes, messages_dropped, metrics, record_timings, stage_seconds
 from PIL import Image
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import time
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@dataclass(slots=True)
 class Client:
+    id: str
     ws: web.WebSocketResponse
     platform: str
     ip: str
+    version: str = "unknown"
+    features: frozenset = frozenset()
+    # Clients sharing a pairing key talk to each other: ("ip", address) by
+    # default, ("key", value) when the client passes an explicit key
+    pair_key: tuple = ()
+    outbox: "Outbox | None" = None
+
+
+class OutboundMessage:
+    """A message plus its wire encodings, each built on first use.
+
+    One instance is shared by every recipient of a broadcast, so a payload
+    is serialized at most once as JSON (ComfyUI clients) and once as msgpack
+    (Photoshop clients) however many clients receive it. `msg_type` wraps
+    the payload as `{msg_type: payload}`; without it the payload is sent
+    as is, and `text` can carry JSON that was already received or encoded.
+    With `since` (a `time.perf_counter()` value), the time until the message
+    is on each socket is recorded as the `<msg_type>_delivery` stage.
+    """
+
+    __slots__ = ("msg_type", "payload", "since", "_json", "_msgpack")
+
+    def __init__(self, msg_type: str, payload=True, text: str | None = None, since: float | None = None):
+        self.msg_type = msg_type
+        self.payload = payload
+        self.since = since
+        self._json = text
+        self._msgpack = None
+
+    @classmethod
+    def forward(cls, msg: dict, text: str | None = None) -> "OutboundMessage":
+        return cls("", msg, text)
+
+    @property
+    def json(self) -> str:
+        if self._json is None:
+            if self.msg_type:
+                self._json = json.dumps({self.msg_type: self.payload})
+            elif isinstance(self.payload, str):
+                # Pre-encoded text goes out untouched
+                self._json = self.payload
+            else:
+                self._json = json.dumps(self.payload)
+        return self._json
+
+    @property
+    def packed(self) -> bytes:
+        if self._msgpack is None:
+            payload = self.payload
+            if self.msg_type:
+                payload = {self.msg_type: payload}
+            elif isinstance(payload, str) and payload.strip().startswith(("{", "[")):
+                payload = json.loads(payload)
+            self._msgpack = msgpack.packb(payload)
+        return self._msgpack
+
+    def encode_for(self, platform: str) -> str | bytes:
+        return self.packed if platform == "ps" else self.json
+
+
+class Outbox:
+    """Bounded outbound queue for one client, drained by its own writer task.
+
+    Senders only enqueue, so a slow client never stalls the caller or other
+    recipients. The queue is bounded both in messages and in bytes; a single
+    message larger than the byte budget is still accepted into an empty
+    queue. When the queue is full `policy` decides what happens: "drop"
+    discards the new message, "coalesce" drops the queued status message of
+    the same type and appends the new one (other messages are dropped) and
+    "disconnect" closes the socket so the client reconnects and resyncs.
+    """
+
+    POLICIES = ("drop", "coalesce", "disconnect")
+    # Messages whose newest value supersedes every earlier one
+    COALESCIBLE = frozenset({"psConnected", "cmConnected", "latestVer", "serverFeatures", "queue"})
+
+    def __init__(self, client: Client, limit: int, policy: str, byte_limit: int = 0):
+        self.client = client
+        self.limit = max(1, limit)
+        self.byte_limit = byte_limit
+        self.policy = policy if policy in self.POLICIES else "coalesce"
+        self._queue: deque[list] = deque()
+        self._bytes = 0
+        self._ready = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    @property
+    def queued_bytes(self) -> int:
+        return self._bytes
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._clear()
+
+    def _clear(self) -> None:
+        self._queue.clear()
+        self._bytes = 0
+
+    def _full(self, size: int) -> bool:
+        if not self._queue:
+            return False
+        return len(self._queue) >= self.limit or (self.byte_limit > 0 and self._bytes + size > self.byte_limit)
+
+    def put(self, msg_type: str, data: str | bytes, since: float | None = None) -> bool:
+        size = len(data)
+        if self._full(size):
+            if self.policy == "coalesce" and msg_type in self.COALESCIBLE:
+                for item in reversed(self._queue):
+                    if item[0] == msg_type:
+                        # Remove rather than overwrite, so the new copy keeps its place after everything queued before it
+                        self._queue.remove(item)
+                        self._bytes -= len(item[1])
+                        messages_dropped.inc(1, self.client.platform, "coalesced")
+                        return self._append(msg_type, data, since)
+            elif self.policy == "disconnect":
+                logger.warning(f"Client {self.client.id} is too slow ({len(self._queue)} queued, {self._bytes} bytes), disconnecting")
+                messages_dropped.inc(len(self._queue) + 1, self.client.platform, "disconnected")
+                self._clear()
+                asyncio.ensure_future(self.client.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b"slow consumer"))
+                return False
+            logger.warning(f"Client {self.client.id} is too slow, dropping {msg_type or 'message'} ({size} bytes)")
+            messages_dropped.inc(1, self.client.platform, "dropped")
+            return False
+        return self._append(msg_type, data, since)
+
+    def _append(self, msg_type: str, data: str | bytes, since: float | None) -> bool:
+        self._queue.append([msg_type, data, since])
+        self._bytes += len(data)
+        self._ready.set()
+        return True
+
+    async def _run(self) -> None:
+        ws = self.client.ws
+        while True:
+            while not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+            msg_type, data, since = self._queue.popleft()
+            self._bytes -= len(data)
+            try:
+                start = time.perf_counter()
+                if isinstance(data, bytes):
+                    await ws.send_bytes(data)
+                else:
+                    await ws.send_str(data)
+                stage_seconds.observe(time.perf_counter() - start, "ws_send")
+                if since is not None:
+                    stage_seconds.observe(time.perf_counter() - since, f"{msg_type}_delivery")
+                # Text is counted in characters; outbound JSON is ASCII
+                platform = self.client.platform
+                message_bytes.observe(len(data), "out", platform)
+                bytes_sent.inc(len(data), platform)
+            except Exception as e:
+                logger.error(f"Error sending message to user {self.client.id}: {e}")
+                if ws.closed:
+                    self._clear()
+                    return
+
+
+class ClientRegistry:
+    """Connected clients indexed by id, platform and pairing key.
+
+    Every method is synchronous, so each update is atomic with respect to
+    other coroutines even when connects and disconnects interleave across
+    `await` points. Index values are insertion-ordered dicts used as sets.
+    """
+
+    def __init__(self):
+        self._by_id: dict[str, Client] = {}
+        self._by_platform: dict[str, dict[str, Client]] = {}
+        self._by_pair: dict[tuple[str, tuple], dict[str, Client]] = {}
+
+    def __contains__(self, client_id: str) -> bool:
+        return client_id in self._by_id
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def get(self, client_id: str) -> Client | None:
+        return self._by_id.get(client_id)
+
+    def add(self, client: Client) -> None:
+        # A reconnect with the same id replaces the old record
+        previous = self._by_id.get(client.id)
+        if previous is not None:
+            self._unindex(previous)
+        self._by_id[client.id] = client
+        self._by_platform.setdefault(client.platform, {})[client.id] = client
+        self._by_pair.setdefault((client.platform, client.pair_key), {})[client.id] = client
+
+    def remove(self, client_id: str, ws: web.WebSocketResponse | None = None) -> Client | None:
+        """Drop a client; with `ws`, only if that socket still owns the id."""
+        client = self._by_id.get(client_id)
+        if client is None or (ws is not None and client.ws is not ws):
+            return None
+        del self._by_id[client_id]
+        self._unindex(client)
+        return client
+
+    def _unindex(self, client: Client) -> None:
+        for index, key in ((self._by_platform, client.platform), (self._by_pair, (client.platform, client.pair_key))):
+            bucket = index.get(key)
+            if bucket is not None:
+                bucket.pop(client.id, None)
+                if not bucket:
+                    del index[key]
+
+    def ids(self, platform: str) -> list[str]:
+        return list(self._by_platform.get(platform, ()))
+
+    def clients(self) -> list[Client]:
+        return list(self._by_id.values())
+
+    def peers(self, client_id: str, platform: str) -> list[str] | None:
+        """Clients on `platform` paired with `client_id`, or None if it is unknown."""
+        client = self._by_id.get(client_id)
+        if client is None:
+            return None
+        return list(self._by_pair.get((platform, client.pair_key), ()))
+
+
+UPLOAD_FRAMES = ("uploadChunk", "uploadBegin", "uploadEnd", "uploadCancel")
 
 
 class WebSocketManager:
     def __init__(self):
-        self.clients: dict[str, Client] = {}
-        self.photoshop_users: list[str] = []
-        self.comfyui_users: list[str] = []
-
-    async def handle_cm_messages(self, msg: dict) -> None:
+        self.registry = ClientRegistry()
+        self.uploads = UploadManager()
+        # The server's event loop, for callers on other threads (set by BPserver)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        # Layer namespaces of disconnected PS clients, waiting out the grace period
+        self._namespace_drops: dict[str, asyncio.TimerHandle] = {}
+
+    def connect(self, client: Client) -> None:
+        """Register a client and start the writer task that feeds its socket."""
+        previous = self.registry.get(client.id)
+        if previous is not None and previous.outbox is not None:
+            asyncio.ensure_future(previous.outbox.close())
+        client.outbox = Outbox(client, settings.send_queue_limit, settings.slow_client_policy, settings.send_queue_bytes)
+        client.outbox.start()
+        self.registry.add(client)
+        pending_drop = self._namespace_drops.pop(client.id, None)
+        if pending_drop is not None:
+            # Reconnected in time; its layers are still current
+            pending_drop.cancel()
+
+    def route(self, sender_id: str, platform: str) -> list[str]:
+        """Recipients on `platform` for a message from `sender_id`.
+
+        Only clients paired with the sender get it; an unknown sender falls
+        back to everyone on that platform.
+        """
+        peers = self.registry.peers(sender_id, platform)
+        return self.registry.ids(platform) if peers is None else peers
+
+    def input_store(self, cm_uid: str) -> LayerStore:
+        """The layer store a prompt queued by `cm_uid` reads from: the most
+        recently active PS client paired with it. Prompts from unknown tabs,
+        e.g. queued through the API, read the most recently active one overall.
+        """
+        return layer_stores.resolve(self.registry.peers(cm_uid, "ps") if cm_uid else None)
+
+    def release_namespace(self, client_id: str) -> None:
+        """Drop a PS client's layers once it has stayed away for the grace period."""
+        if layer_stores.find(client_id) is None:
+            return
+        loop = asyncio.get_running_loop()
+        previous = self._namespace_drops.pop(client_id, None)
+        if previous is not None:
+            previous.cancel()
+        self._namespace_drops[client_id] = loop.call_later(settings.namespace_grace, self._drop_namespace, client_id)
+
+    def _drop_namespace(self, client_id: str) -> None:
+        self._namespace_drops.pop(client_id, None)
+        if client_id not in self.registry:
+            layer_stores.drop(client_id)
+
+    async def handle_cm_messages(self, msg: dict, sender_id: str = "", text: str | None = None) -> None:
         if "pullupdate" in msg:
-            await self.send_message(self.comfyui_users, "alert", "Updating, please Restart comfyui after update")
+            await self.send_message(self.registry.ids("cm"), "alert", "Updating, please Restart comfyui after update")
             force_pull()
         elif "install_plugin" in msg:
             install_plugin()
         else:
-            # Only send to PS clients with the same IP
-            sender_id = msg.get("_sender_id", "")
-            sender_ip = self.clients[sender_id].ip if sender_id in self.clients else None
-            if sender_ip:
-                ps_users_same_ip = [uid for uid in self.photoshop_users if uid in self.clients and self.clients[uid].ip == sender_ip]
-                await self.send_message(ps_users_same_ip, "", json.dumps(msg))
-            else:
-                await self.send_message(self.photoshop_users, "", json.dumps(msg))
+            # Only send to PS clients paired with the sender
+            await self.send(self.route(sender_id, "ps"), OutboundMessage.forward(msg, text))
 
     async def handle_ps_messages(self, msg: dict, sender_id: str) -> None:
         if "combinedData" in msg:
             combinedData = msg["combinedData"]
-            if "changedImages" in combinedData:
-                await process_changed_images(combinedData["changedImages"])
-            if "maskBase64" in combinedData:
-                await process_and_save_mask(combinedData["maskBase64"], "SELECTION.png")
-            
-            # Get sender IP
-            sender_ip = self.clients[sender_id].ip if sender_id in self.clients else None
-            if sender_ip:
-                # Only send to CM clients with the same IP
-                cm_users_same_ip = [uid for uid in self.comfyui_users if uid in self.clients and self.clients[uid].ip == sender_ip]
-                await self.send_message(cm_users_same_ip, "queue", True)
-            else:
-                await self.send_message(self.comfyui_users, "queue", True)
+            # Each PS client's layers live in their own namespace
+            store = layer_stores.get(sender_id)
+            versions = {}
+            stale_titles = []
+            # Nodes reading these layers wait for this message to finish instead of reading the old version
+            with store.ingesting(incoming_titles(combinedData)):
+                if "changedImages" in combinedData:
+                    results = await process_changed_images(combinedData["changedImages"], store)
+                    versions.update({r["title"]: r["version"] for r in results if isinstance(r, dict) and r["success"]})
+                if "changedTiles" in combinedData:
+                    loop = asyncio.get_event_loop()
+                    applied, stale_titles = await loop.run_in_executor(None, apply_changed_tiles, combinedData["changedTiles"], store)
+                    versions.update(applied)
+                if "maskBase64" in combinedData:
+                    await process_and_save_mask(combinedData["maskBase64"], "SELECTION.png", store)
+
+            # Delta-capable plugins need the stored version to base their next tiles on
+            sender = self.registry.get(sender_id)
+            if sender and "delta" in sender.features and versions:
+                await self.send_message([sender_id], "layerVersions", versions)
+            if stale_titles:
+                # Queueing now would render stale layers; the plugin resends them as full frames
+                await self.send_message([sender_id], "layerResync", stale_titles)
+                return
+
+            # Only send to CM clients paired with the sender
+            await self.send_message(self.route(sender_id, "cm"), "queue", True)
 
         if not ("combinedData" in msg):
-            # Get sender IP
-            sender_ip = self.clients[sender_id].ip if sender_id in self.clients else None
-            if sender_ip:
-                # Only send to CM clients with the same IP
-                cm_users_same_ip = [uid for uid in self.comfyui_users if uid in self.clients and self.clients[uid].ip == sender_ip]
-                await self.send_message(cm_users_same_ip, "", json.dumps(msg))
+            await self.send(self.route(sender_id, "cm"), OutboundMessage.forward(msg))
+
+    async def handle_upload_message(self, msg: dict, sender_id: str) -> None:
+        frame = next(key for key in UPLOAD_FRAMES if key in msg)
+        body = msg[frame]
+        upload_id = body.get("id", "") if isinstance(body, dict) else ""
+        try:
+            if frame == "uploadChunk":
+                self.uploads.chunk(sender_id, upload_id, body.get("offset", 0), body["data"])
+            elif frame == "uploadBegin":
+                self.uploads.begin(sender_id, upload_id, body["size"])
+            elif frame == "uploadEnd":
+                upload = self.uploads.end(sender_id, upload_id)
+                stage_seconds.observe(time.perf_counter() - upload.started, "upload")
+                await self.send_message([sender_id], "uploadComplete", upload_id)
             else:
-                await self.send_message(self.comfyui_users, "", json.dumps(msg))
+                self.uploads.cancel(sender_id, upload_id)
+        except (UploadError, KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Upload {upload_id} from {sender_id} failed: {e}")
+            self.uploads.cancel(sender_id, upload_id)
+            await self.send_message([sender_id], "uploadError", {"id": upload_id, "error": str(e)})
 
     async def handle_client_message(self, client_id: str, platform: str, data: str | bytes) -> None:
         try:
+            message_bytes.observe(len(data), "in", platform)
             if platform == "ps":
-                msg = msgpack.unpackb(data, raw=False)
-                await self.handle_ps_messages(msg, client_id)
+                with stage_seconds.time("msgpack_decode"):
+                    msg = msgpack.unpackb(data, raw=False)
+                if isinstance(msg, dict) and any(frame in msg for frame in UPLOAD_FRAMES):
+                    await self.handle_upload_message(msg, client_id)
+                    return
+                sender = self.registry.get(client_id)
+                claimed = []
+                try:
+                    if sender and "chunked" in sender.features:
+                        # Swap upload references for the reassembled bytes
+                        msg = self.uploads.resolve(client_id, msg, claimed)
+                    await self.handle_ps_messages(msg, client_id)
+                finally:
+                    for upload in claimed:
+                        upload.close()
             else:
-                msg = json.loads(data)
-                # Add sender ID to message for IP filtering
-                msg["_sender_id"] = client_id
-                await self.handle_cm_messages(msg)
+                with stage_seconds.time("json_decode"):
+                    msg = json.loads(data)
+                # The sender routes the message; the original text is reused if it is re-encoded as JSON
+                await self.handle_cm_messages(msg, client_id, data if isinstance(data, str) else None)
 
         except (json.JSONDecodeError, msgpack.exceptions.ExtraData) as e:
             logger.error(f"Invalid message format received from {platform}: {e}")
         except Exception as e:
             logger.error(f"Error processing message from {platform}: {e}")
 
-    async def handle_client_disconnect(self, client_id: str, platform: str) -> None:
+    async def handle_client_disconnect(self, client_id: str, platform: str, ws: web.WebSocketResponse | None = None) -> None:
         try:
-            if client_id in self.clients:
-                del self.clients[client_id]
-
-            user_list = self.photoshop_users if platform == "ps" else self.comfyui_users
-            if client_id in user_list:
-                user_list.remove(client_id)
+            # A newer connection may already own this id; leave it alone
+            client = self.registry.remove(client_id, ws)
+            if client is not None:
+                self.uploads.discard_client(client_id)
+            if client is not None and platform == "ps":
+                self.release_namespace(client_id)
+            if client is not None and client.outbox is not None:
+                await client.outbox.close()
         except Exception as e:
             logger.error(f"Error handling disconnect for {client_id}: {e}")
 
-    async def send_message(self, users: list[str], msg_type: str, message: str | bool = True) -> None:
+    async def send_render_batch(self, users: list[str], batch_results: list[dict], since: float | None = None) -> None:
+        # Plugins that advertise "bin" get the PNG bytes as msgpack bin; older ones
+        # still expect a Uint8Array-style list with one int per byte. Each group
+        # shares one message, so the batch is packed once per group, not per client.
+        binary_users = [uid for uid in users if uid in self.registry and "bin" in self.registry.get(uid).features]
+        legacy_users = [uid for uid in users if uid not in binary_users]
+
+        if binary_users:
+            await self.send(binary_users, OutboundMessage("render_batch", batch_results, since=since))
+        if legacy_users:
+            legacy_results = [{**result, "image": list(result["image"])} for result in batch_results]
+            await self.send(legacy_users, OutboundMessage("render_batch", legacy_results, since=since))
+
+    def render_recipients(self, cm_uid: str, count: int) -> list[str]:
+        """The PS clients paired with `cm_uid`, or every PS client if it is unknown."""
+        if cm_uid and cm_uid in self.registry:
+            cm_ip = self.registry.get(cm_uid).ip
+            ps_users = self.registry.peers(cm_uid, "ps")
+            if ps_users:
+                print(f"# PS: from {cm_uid}, {count} images sent to {len(ps_users)}, IP: {cm_ip}")
+            else:
+                print(f"# PS: No PS users found with the same IP as cmUID: {cm_uid}, IP: {cm_ip}")
+            return ps_users
+        print(f"# PS: Batch of {count} images sent to all PS users. cmUID: {cm_uid} was not found or not provided")
+        return self.registry.ids("ps")
+
+    async def deliver_renders(self, cm_uid: str, batch_results: list[dict], since: float | None = None) -> None:
+        """Send already encoded renders to the PS clients for `cm_uid`."""
+        users = self.render_recipients(cm_uid, len(batch_results))
+        if users:
+            await self.send_render_batch(users, batch_results, since)
+
+    async def deliver_pixels(self, cm_uid: str, renders: list[tuple], since: float | None = None) -> None:
+        """Encode (pixels, source_bounds, filename) renders on the render pool, then deliver them.
+
+        Plugins that advertise "crop" get only the visible region of each
+        render, placed by its sourceBounds; the full frame is only encoded
+        if some recipient still needs it.
+        """
+        users = self.render_recipients(cm_uid, len(renders))
+        if not users:
+            return
+        crop_users = [uid for uid in users if settings.render_crop and uid in self.registry and "crop" in self.registry.get(uid).features]
+        full_users = [uid for uid in users if uid not in crop_users]
+
+        loop = asyncio.get_running_loop()
+        for group, crop in ((crop_users, True), (full_users, False)):
+            if group:
+                batch_results = await asyncio.gather(*(loop.run_in_executor(render_executor, encode_render, *render, crop) for render in renders))
+                await self.send_render_batch(group, list(batch_results), since)
+
+    def deliver_pixels_threadsafe(self, cm_uid: str, renders: list[tuple], since: float | None = None) -> concurrent.futures.Future:
+        """`deliver_pixels` for node code running outside the server loop; does not wait."""
+        return self._run_threadsafe(self.deliver_pixels(cm_uid, renders, since))
+
+    def _run_threadsafe(self, coro) -> concurrent.futures.Future:
+        if self.loop is None or self.loop.is_closed():
+            coro.close()
+            raise RuntimeError("The ComfyUI server loop is not running")
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(_log_delivery_error)
+        return future
+
+    async def send_message(self, users: list[str], msg_type: str, message: str | bool | list = True) -> None:
+        await self.send(users, OutboundMessage(msg_type, message))
+
+    async def send(self, users: list[str], message: OutboundMessage) -> None:
+        """Queue a message on each recipient's outbox; never waits on a socket.
+
+        Each wire format is encoded once, on the first recipient that needs it.
+        """
         if not users:
             logger.warning("No users connected")
             return
 
         for user_id in users:
-            if user_id in self.clients:
+            client = self.registry.get(user_id)
+            if client is not None:
                 try:
-                    if self.clients[user_id].platform == "ps":
-                        if msg_type:
-                            payload = {msg_type: message}
-                        else:
-                            payload = json.loads(message) if isinstance(message, str) and message.strip().startswith(('{', '[')) else message
-                        data = msgpack.packb(payload)
-                        await self.clients[user_id].ws.send_bytes(data)
-                    else:
-                        data = json.dumps({msg_type: message}) if msg_type else message
-                        await self.clients[user_id].ws.send_str(data)
+                    client.outbox.put(message.msg_type, message.encode_for(client.platform), message.since)
                 except Exception as e:
                     logger.error(f"Error sending message to user {user_id}: {e}")
             else:
                 logger.warning(f"User {user_id} not connected")
 
 
-ws_manager = WebSocketManager()
+def _log_delivery_error(future: concurrent.futures.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Error delivering renders: {future.exception()}")
 
 
-def _process_image_sync(index: int, image_dict: dict, psimg_path: str) -> dict:
-    """Synchronous image processing (runs in thread pool)"""
-    title = "Untitled"
-    try:
-        title = image_dict["title"]
-        image_info = image_dict["imageInfo"]
+RENDER_METADATA_LIMIT = 256
+# Size and bounds of renders the node has already measured, keyed by file path
+_render_metadata: OrderedDict[str, tuple[dict, dict]] = OrderedDict()
+_render_metadata_lock = threading.Lock()
 
-        if isinstance(image_info, str) and image_info.startswith("/9j/"):
-            # JPEG base64
-            image_bytes = base64.b64decode(image_info)
-            image = Image.open(io.BytesIO(image_bytes))
-            width, height = image.size
-
-            # Save image directly
-            save_path = os.path.join(psimg_path, f"{title}.png")
-            image.save(save_path)
-            return {"success": True, "title": title, "size": (width, height)}
-
-        # Raw image data
-        image_data = image_info["imageData"]
-        transparent = image_info.get("transparent", False)
-        width = image_info["width"]
-        height = image_info["height"]
-
-        expected_size_with_alpha = height * width * 4
-        expected_size_without_alpha = height * width * 3
-
-        if len(image_data) == expected_size_with_alpha:
-            channels = 4
-        elif len(image_data) == expected_size_without_alpha:
-            channels = 3
-        else:
-            raise ValueError(f"Invalid image data size. Expected {expected_size_with_alpha} or {expected_size_without_alpha}, got {len(image_data)}")
 
-        image_array = np.array(image_data, dtype=np.uint8).reshape((height, width, channels))
+def remember_render(path: str, size: dict, source_bounds: dict) -> None:
+    with _render_metadata_lock:
+        _render_metadata[os.path.abspath(path)] = (size, source_bounds)
+        _render_metadata.move_to_end(os.path.abspath(path))
+        while len(_render_metadata) > RENDER_METADATA_LIMIT:
+            _render_metadata.popitem(last=False)
 
-        mode = "RGBA" if channels == 4 else "RGB"
-        image = Image.fromarray(image_array, mode=mode)
 
-        source_bounds = image_info.get("sourceBounds", {"left": 0, "right": width, "top": 0, "bottom": height})
-        left = source_bounds.get("left", 0)
-        right = source_bounds.get("right", width)
-        top = source_bounds.get("top", 0)
-        bottom = source_bounds.get("bottom", height)
+def render_metadata(path: str, data: bytes) -> tuple[dict, dict]:
+    """Size and visible bounds of a render, decoding it only when nothing cheaper knows them."""
+    with _render_metadata_lock:
+        known = _render_metadata.get(os.path.abspath(path))
+    if known is not None:
+        return known
 
-        source_width = right - left
-        source_height = bottom - top
+    header = png_header(data)
+    if header is not None and not header[2]:
+        # No alpha channel and no tRNS: every pixel is visible
+        width, height = header[0], header[1]
+        return {"width": width, "height": height}, {"left": 0, "top": 0, "right": width, "bottom": height}
 
-        resized_image = image.resize((source_width, source_height), Image.Resampling.LANCZOS)
-        is_full_size = left == 0 and right == width and top == 0 and bottom == height
+    image = Image.open(io.BytesIO(data))
+    alpha = image.getchannel("A") if image.mode == "RGBA" else image.convert("RGBA").getchannel("A")
+    width, height = image.size
+    bbox = alpha.getbbox() or (0, 0, width, height)
+    return {"width": width, "height": height}, {"left": bbox[0], "top": bbox[1], "right": bbox[2], "bottom": bbox[3]}
 
-        if is_full_size:
-            final_image = resized_image
-        else:
-            if channels == 4:
-                background = (0, 0, 0, 0)
-            else:
-                background = (255, 255, 255)
 
-            background_image = Image.new(mode, (width, height), background)
-            background_image.paste(resized_image, (left, top))
-            final_image = background_image
+def load_render(path: str, filename: str) -> dict:
+    """Read a saved render and find the bounds of its visible pixels."""
+    with stage_seconds.time("render_read"):
+        with open(path, "rb") as image_file:
+            file_content = image_file.read()
 
-        # Save final image
-        save_path = os.path.join(psimg_path, f"{title}.png")
-        final_image.save(save_path)
-        return {"success": True, "title": title, "size": (width, height)}
+    with stage_seconds.time("render_bbox"):
+        size, source_bounds = render_metadata(path, file_content)
 
-    except Exception as e:
-        logger.error(f"❌ Error processing image ({title}): {e}", exc_info=True)
-        return {"success": False, "title": title, "error": str(e)}
+    # Raw PNG bytes travel as msgpack bin; see send_render_batch for older plugins
+    return {"image": file_content, "size": size, "sourceBounds": source_bounds, "filename": filename}
+
+
+def encode_render(pixels: np.ndarray, source_bounds: dict, filename: str, crop: bool = False) -> dict:
+    """Encode an RGB/RGBA uint8 render whose bounds are already known; no disk involved.
 
+    With `crop`, only the `source_bounds` region is encoded and `size` stays
+    the full canvas, so the plugin places the image at the bounds' offset.
+    """
+    height, width = pixels.shape[:2]
+    cropped = crop and (source_bounds["right"] - source_bounds["left"], source_bounds["bottom"] - source_bounds["top"]) != (width, height)
+    if cropped:
+        pixels = pixels[source_bounds["top"] : source_bounds["bottom"], source_bounds["left"] : source_bounds["right"]]
+    with stage_seconds.time("render_encode"):
+        data = encode(pixels, "png", settings.render_png_compress_level)
+    return {"image": data, "size": {"width": width, "height": height}, "sourceBounds": source_bounds, "filename": filename, "cropped": cropped}
 
-async def process_single_image(index: int, image_dict: dict, executor: ThreadPoolExecutor) -> None:
-    """Process a single image using thread pool"""
+
+# PNG encoding releases the GIL in zlib, so a batch encodes in parallel
+render_executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings.ingest_workers, thread_name_prefix="ps-render")
+
+
+ws_manager = WebSocketManager()
+ingest_pool = IngestPool(settings.ingest_mode, settings.ingest_workers, ResamplePolicy(settings.resample_quality, settings.resample_reduce))
+metrics.gauge(
+    "bluepixel_client_queue_depth",
+    "Messages waiting in each client's outbound queue.",
+    ("client", "platform"),
+    collect=lambda: {(client.id, client.platform): client.outbox.depth for client in ws_manager.registry.clients() if client.outbox is not None},
+)
+metrics.gauge(
+    "bluepixel_client_queue_bytes",
+    "Bytes waiting in each client's outbound queue.",
+    ("client", "platform"),
+    collect=lambda: {(client.id, client.platform): client.outbox.queued_bytes for client in ws_manager.registry.clients() if client.outbox is not None},
+)
+
+
+def incoming_titles(combined_data: dict) -> set:
+    """Layer titles a `combinedData` message is about to replace."""
+    titles = {
+        item.get("title", "Untitled")
+        for key in ("changedImages", "changedTiles")
+        for item in combined_data.get(key) or ()
+        if isinstance(item, dict)
+    }
+    if "maskBase64" in combined_data:
+        titles.add("SELECTION")
+    return titles
+
+
+async def process_single_image(index: int, image_dict: dict, store: LayerStore = layer_store) -> dict:
+    """Decode a single image on the ingest pool and publish it to the layer store"""
     logger.info(f"🔵 Processing image {index}: {image_dict.keys()}")
-    
-    # Run CPU-intensive work in thread pool
-    loop = asyncio.get_event_loop()
-    result = await loop.run_in_executor(executor, _process_image_sync, index, image_dict, dirs.psimg)
-    
+
+    title = "Untitled"
+    try:
+        title = image_dict["title"]
+        image_info = image_dict["imageInfo"]
+        path = ingest_path(image_info)
+        start = time.perf_counter()
+        timings = {}
+        pixels = await ingest_pool.decode(image_info, timings)
+        record_timings(timings)
+
+        # Publish the decoded layer (hashing it off the loop); the file copy is written in the background
+        entry = await asyncio.get_event_loop().run_in_executor(None, store.put, title, pixels)
+        stage_seconds.observe(time.perf_counter() - start, "ingest")
+        result = {"success": True, "title": title, "size": entry.size, "path": path, "version": entry.version}
+    except Exception as e:
+        logger.error(f"❌ Error processing image ({title}): {e}", exc_info=True)
+        result = {"success": False, "title": title, "error": str(e)}
+
     if result["success"]:
-        logger.info(f"✅ Image saved: {result['title']} ({result['size'][0]}x{result['size'][1]})")
+        logger.info(f"✅ Image stored: {result['title']} ({result['size'][0]}x{result['size'][1]}, {result['path']} ingest)")
     else:
         logger.error(f"❌ Failed to process: {result['title']} - {result.get('error', 'Unknown error')}")
+    return result
 
 
-async def process_changed_images(image_list: list) -> None:
-    """Process multiple images in parallel using thread pool"""
+async def process_changed_images(image_list: list, store: LayerStore = layer_store) -> list:
+    """Process multiple images in parallel on the shared ingest pool"""
     if not image_list:
-        return
-        
+        return []
+
     logger.info(f"🚀 Processing {len(image_list)} images in parallel...")
-    
-    # Create thread pool executor (max workers = number of images or 4, whichever is smaller)
-    max_workers = min(len(image_list), 4)
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Create tasks for parallel processing
-        tasks = [process_single_image(index, image_dict, executor) for index, image_dict in enumerate(image_list)]
-        
-        # Process all images concurrently
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-    
+
+    tasks = [process_single_image(index, image_dict, store) for index, image_dict in enumerate(image_list)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
     # Log any errors
-    errors = [r for r in results if isinstance(r, Exception)]
+    errors = [r for r in results if isinstance(r, Exception) or not r["success"]]
     if errors:
         logger.warning(f"⚠️ {len(errors)} images failed to process")
     else:
         logger.info(f"✅ Successfully processed all {len(image_list)} images")
+    return results
 
 
-async def process_and_save_mask(mask_data: dict, output_filename: str) -> None:
-    try:
-
-        mask_array = mask_data.get("maskData", None)
-        width = max(1, int(mask_data.get("width", 0)))
-        height = max(1, int(mask_data.get("height", 0)))
-        sourcebounds = mask_data.get("sourcebounds", None)
-
-        bg = Image.new("L", (width, height), 0)
-
-        if mask_array is None or (hasattr(mask_array, "data") and mask_array.data is None):
-            output_path = os.path.join(dirs.psimg, output_filename)
-            bg.save(output_path)
-            return
-
-        if hasattr(mask_array, "data"):
-            mask_array = mask_array.data
-
-        mask_np = np.frombuffer(mask_array, dtype=np.uint8)
-
-        if mask_np.size == 0:
-            output_path = os.path.join(dirs.psimg, output_filename)
-            bg = Image.new("L", (width, height), 255)
-            bg.save(output_path)
-            return
+def apply_changed_tiles(tile_updates: list, store: LayerStore = layer_store) -> tuple[dict, list]:
+    """Patch dirty rectangles into stored layers (runs in thread pool).
 
-        expected_size = width * height
-        if mask_np.size != expected_size:
-
-            mask_np = np.zeros(expected_size, dtype=np.uint8)
-
-        mask_np = mask_np.reshape((height, width))
-
-        raw_mask_image = Image.fromarray(mask_np, mode="L")
-        # raw_output_path = os.path.join(dirs.psimg, "RAWMASK.png")
-        # raw_mask_image.save(raw_output_path)
-        # logger.info(f"Raw mask saved successfully: {raw_output_path}")
-
-        if sourcebounds:
-            left = max(0, round(sourcebounds.get("left", 0)))
-            right_pad = max(0, round(sourcebounds.get("right", 0)))
-            top = max(0, round(sourcebounds.get("top", 0)))
-            bottom_pad = max(0, round(sourcebounds.get("bottom", 0)))
-
-            new_width = max(0, width - left - right_pad)
-            new_height = max(0, height - top - bottom_pad)
-
-            if new_width <= 0 or new_height <= 0:
-                new_width = width
-                new_height = height
-                left = 0
-                top = 0
-
-            resized_mask = raw_mask_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    Each update carries the layer title, the store version its tiles were cut
+    against and a list of tiles with offsets in stored-image pixels. Returns
+    the new versions and the titles that need a full frame instead.
+    """
+    applied = {}
+    stale_titles = []
+    for update in tile_updates:
+        title = update.get("title", "Untitled")
+        try:
+            tiles = [
+                (int(tile["left"]), int(tile["top"]), int(tile["width"]), int(tile["height"]), as_uint8(tile["data"]))
+                for tile in update.get("tiles", [])
+            ]
+            entry = store.apply_tiles(title, update.get("baseVersion"), tiles)
+        except Exception as e:
+            logger.error(f"❌ Error applying tiles ({title}): {e}", exc_info=True)
+            entry = None
 
-            bg.paste(resized_mask, (left, top))
+        if entry is None:
+            logger.info(f"🔁 Layer {title} needs a full frame (base v{update.get('baseVersion')} is stale)")
+            stale_titles.append(title)
         else:
+            applied[title] = entry.version
+            logger.info(f"✅ Applied {len(tiles)} tiles to {title} (v{entry.version})")
+    return applied, stale_titles
 
-            bg.paste(raw_mask_image, (0, 0))
-
-        output_path = os.path.join(dirs.psimg, output_filename)
-        bg.save(output_path)
 
-    except Exception as e:
-        logger.error(f"Error processing and saving mask: {e}", exc_info=True)
+async def process_and_save_mask(mask_data: dict, output_filename: str, store: LayerStore = layer_store) -> None:
+    """Build the selection mask off the loop and publish it to the layer store."""
+    output_name = os.path.splitext(output_filename)[0]
+    loop = asyncio.get_event_loop()
+    with stage_seconds.time("mask"):
         try:
-
-            bg = Image.new("L", (max(1, width), max(1, height)), 0)
-            output_path = os.path.join(dirs.psimg, output_filename)
-            bg.save(output_path)
-        except Exception as save_error:
-            logger.error(f"Error saving fallback image: {save_error}", exc_info=True)
+            mask = await loop.run_in_executor(None, decode_mask, mask_data, ingest_pool.policy)
+        except Exception as e:
+            logger.error(f"Error processing mask, clearing the selection: {e}", exc_info=True)
+            mask = np.zeros((max(1, int(mask_data.get("height", 0))), max(1, int(mask_data.get("width", 0)))), dtype=np.uint8)
+        try:
+            await loop.run_in_executor(None, store.put, output_name, mask)
+        except Exception as e:
+            logger.error(f"Error storing mask: {e}", exc_info=True)
@@ -0,0 +1,144 @@
+"""Storage formats for the layer copies in `ps_inputs/imgs`.
+
+Files are written with a format-specific extension, but readers always
+sniff the header, so the configured format can change between runs.
+
+- png:  PNG at a configurable `compress_level`
+- npy:  uncompressed NumPy array with its small header, memory-mappable
+- zstd: zstd-compressed `.npy` (needs Python 3.14+ or the `zstandard` package)
+"""
+
+import contextlib
+import io
+import logging
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+NPY_MAGIC = b"\x93NUMPY"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+EXTENSIONS = {"png": ".png", "npy": ".npy", "zstd": ".npy.zst"}
+
+
+def _zstd():
+    try:
+        from compression import zstd
+
+        return zstd.compress, zstd.decompress
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return (
+        lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+
+def resolve_format(fmt: str) -> str:
+    if fmt not in EXTENSIONS:
+        logger.warning(f"Unknown storage format {fmt!r}, using png")
+        return "png"
+    if fmt == "zstd" and _zstd() is None:
+        logger.warning("zstd storage needs the `zstandard` package, using npy")
+        return "npy"
+    return fmt
+
+
+def encode(pixels: np.ndarray, fmt: str, png_compress_level: int = 1, zstd_level: int = 1) -> bytes:
+    if fmt == "png":
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="PNG", compress_level=png_compress_level)
+        return buffer.getvalue()
+
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(pixels), allow_pickle=False)
+    if fmt == "npy":
+        return buffer.getvalue()
+    compress, _ = _zstd()
+    return compress(buffer.getbuffer(), zstd_level)
+
+
+def write_image(base_path: str, data: bytes, fmt: str) -> str:
+    """Write encoded `data` to `base_path` plus the format's extension.
+
+    The file is written beside its target and renamed over it, so readers
+    see either the previous copy or the complete new one. Copies of the same
+    image in other formats are removed so readers never pick up a stale one.
+    """
+    path = base_path + EXTENSIONS[fmt]
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+    for other, extension in EXTENSIONS.items():
+        if other != fmt and os.path.exists(base_path + extension):
+            os.remove(base_path + extension)
+    return path
+
+
+def png_header(data: bytes) -> tuple[int, int, bool] | None:
+    """(width, height, has_alpha) from a PNG's chunks, without decoding pixels."""
+    if not data.startswith(PNG_MAGIC) or data[12:16] != b"IHDR":
+        return None
+    width = int.from_bytes(data[16:20], "big")
+    height = int.from_bytes(data[20:24], "big")
+    # Colour types 4 and 6 carry an alpha channel; others only via a tRNS chunk
+    if data[25] in (4, 6):
+        return width, height, True
+    position = 8
+    while position + 8 <= len(data):
+        length = int.from_bytes(data[position : position + 4], "big")
+        chunk = data[position + 4 : position + 8]
+        if chunk == b"tRNS":
+            return width, height, True
+        if chunk in (b"IDAT", b"IEND"):
+            break
+        position += length + 12
+    return width, height, False
+
+
+def find_image(base_path: str) -> str | None:
+    for extension in EXTENSIONS.values():
+        if os.path.exists(base_path + extension):
+            return base_path + extension
+    return None
+
+
+def sniff(path: str) -> str:
+    with open(path, "rb") as file:
+        header = file.read(8)
+    if header.startswith(NPY_MAGIC):
+        return "npy"
+    if header.startswith(ZSTD_MAGIC):
+        return "zstd"
+    # PNG, and anything else PIL may know how to open
+    return "png"
+
+
+def read_array(path: str, fmt: str | None = None) -> np.ndarray:
+    """Load an image file as a uint8 array; `.npy` files are memory-mapped."""
+    fmt = fmt or sniff(path)
+    if fmt == "npy":
+        # Copy-on-write: callers get a writable array (torch.from_numpy needs one),
+        # and a write only copies the touched pages, never reaching the file
+        return np.load(path, mmap_mode="c", allow_pickle=False)
+    if fmt == "zstd":
+        _, decompress = _zstd()
+        with open(path, "rb") as file:
+            return np.load(io.BytesIO(decompress(file.read())), allow_pickle=False)
+    with Image.open(path) as image:
+        return np.array(image)
@@ -0,0 +1,175 @@
+"""Pixel work for the ingest path.
+
+Kept free of server imports so ingest worker processes can load it cheaply.
+"""
+
+import base64
+import io
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from PIL import Image
+
+
+def as_uint8(data) -> np.ndarray:
+    if isinstance(data, np.ndarray):
+        return data.reshape(-1)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        # msgpack `bin` payload: wrap the received buffer without touching each sample
+        return np.frombuffer(data, dtype=np.uint8)
+    # Legacy plugins send a list with one Python int per channel sample
+    return np.array(data, dtype=np.uint8)
+
+
+def is_jpeg(image_info) -> bool:
+    return isinstance(image_info, str) and image_info.startswith("/9j/")
+
+
+def ingest_path(image_info) -> str:
+    if is_jpeg(image_info):
+        return "jpeg"
+    return "list" if isinstance(image_info["imageData"], list) else "binary"
+
+
+def raw_shape(image_info: dict, size: int) -> tuple[int, int, int]:
+    width = image_info["width"]
+    height = image_info["height"]
+
+    expected_size_with_alpha = height * width * 4
+    expected_size_without_alpha = height * width * 3
+
+    if size == expected_size_with_alpha:
+        channels = 4
+    elif size == expected_size_without_alpha:
+        channels = 3
+    else:
+        raise ValueError(f"Invalid image data size. Expected {expected_size_with_alpha} or {expected_size_without_alpha}, got {size}")
+    return height, width, channels
+
+
+@dataclass(frozen=True)
+class ResamplePolicy:
+    """How layers are scaled into their sourceBounds.
+
+    `quality` picks the filter for arbitrary scale factors; with `reduce`,
+    exact integer downscales use `Image.reduce` (box averaging), which is
+    far cheaper than any convolution filter.
+    """
+
+    quality: str = "best"
+    reduce: bool = True
+
+
+RESAMPLE_FILTERS = {"fast": Image.Resampling.BILINEAR, "balanced": Image.Resampling.BICUBIC, "best": Image.Resampling.LANCZOS}
+
+
+def resample(array: np.ndarray, size: tuple[int, int], policy: ResamplePolicy) -> tuple[np.ndarray, str]:
+    """Scale an (H, W, C) array to `size` (width, height); returns it and the method used."""
+    height, width = array.shape[:2]
+    target_width, target_height = size
+    if (target_width, target_height) == (width, height):
+        return array, "skip"
+    image = Image.fromarray(array)
+    if policy.reduce and 0 < target_width <= width and 0 < target_height <= height and width % target_width == 0 and height % target_height == 0:
+        return np.asarray(image.reduce((width // target_width, height // target_height))), "reduce"
+    resample_filter = RESAMPLE_FILTERS.get(policy.quality, Image.Resampling.LANCZOS)
+    return np.asarray(image.resize(size, resample_filter)), resample_filter.name.lower()
+
+
+def paste(document: np.ndarray, pixels: np.ndarray, left: int, top: int) -> None:
+    """Copy `pixels` into `document` at (left, top), clipped to the document like PIL's paste."""
+    height, width = document.shape[:2]
+    x0, y0 = max(left, 0), max(top, 0)
+    x1, y1 = min(left + pixels.shape[1], width), min(top + pixels.shape[0], height)
+    if x0 < x1 and y0 < y1:
+        document[y0:y1, x0:x1] = pixels[y0 - top : y1 - top, x0 - left : x1 - left]
+
+
+def decode_layer(image_info, out: np.ndarray | None = None, timings: dict | None = None, policy: ResamplePolicy = ResamplePolicy()) -> np.ndarray:
+    """Turn a changedImages `imageInfo` into a document-sized uint8 array.
+
+    When `out` is given (e.g. a shared-memory buffer) the result is written
+    into it and returned. Stage durations are added to `timings` if given;
+    the resize is recorded as `resize_<method>` so the policy's choices
+    show up in the metrics.
+    """
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    if is_jpeg(image_info):
+        image = Image.open(io.BytesIO(base64.b64decode(image_info))).convert("RGB")
+        timings["jpeg_decode"] = time.perf_counter() - start
+        if out is None:
+            return np.array(image)
+        out[...] = np.asarray(image)
+        return out
+
+    pixels = as_uint8(image_info["imageData"])
+    height, width, channels = raw_shape(image_info, pixels.size)
+    image_array = pixels.reshape((height, width, channels))
+    timings["reshape"] = time.perf_counter() - start
+
+    source_bounds = image_info.get("sourceBounds", {"left": 0, "right": width, "top": 0, "bottom": height})
+    left = source_bounds.get("left", 0)
+    right = source_bounds.get("right", width)
+    top = source_bounds.get("top", 0)
+    bottom = source_bounds.get("bottom", height)
+
+    start = time.perf_counter()
+    resized, method = resample(image_array, (right - left, bottom - top), policy)
+    timings[f"resize_{method}"] = time.perf_counter() - start
+
+    # Compose straight into the document buffer instead of a PIL background image
+    start = time.perf_counter()
+    document = np.empty((height, width, channels), dtype=np.uint8) if out is None else out
+    is_full_size = left == 0 and right == width and top == 0 and bottom == height
+    if not is_full_size:
+        # Transparent for RGBA layers, white for RGB ones
+        document[...] = 0 if channels == 4 else 255
+    paste(document, resized, left, top)
+    timings["compose"] = time.perf_counter() - start
+    return document
+
+
+def decode_mask(mask_data: dict, policy: ResamplePolicy = ResamplePolicy()) -> np.ndarray:
+    """Turn a `maskBase64` payload into a document-sized uint8 selection.
+
+    No mask data means nothing is selected and an empty mask means
+    everything is; the mask is scaled into the document minus the
+    `sourcebounds` padding.
+    """
+    mask_array = mask_data.get("maskData", None)
+    width = max(1, int(mask_data.get("width", 0)))
+    height = max(1, int(mask_data.get("height", 0)))
+    sourcebounds = mask_data.get("sourcebounds", None)
+
+    if hasattr(mask_array, "data"):
+        mask_array = mask_array.data
+    if mask_array is None:
+        return np.zeros((height, width), dtype=np.uint8)
+
+    mask_np = as_uint8(mask_array)
+    if mask_np.size == 0:
+        return np.full((height, width), 255, dtype=np.uint8)
+    if mask_np.size != width * height:
+        raise ValueError(f"Invalid mask data size. Expected {width * height}, got {mask_np.size}")
+    mask_np = mask_np.reshape((height, width))
+
+    left = top = 0
+    new_width, new_height = width, height
+    if sourcebounds:
+        left = max(0, round(sourcebounds.get("left", 0)))
+        top = max(0, round(sourcebounds.get("top", 0)))
+        new_width = width - left - max(0, round(sourcebounds.get("right", 0)))
+        new_height = height - top - max(0, round(sourcebounds.get("bottom", 0)))
+        if new_width <= 0 or new_height <= 0:
+            left = top = 0
+            new_width, new_height = width, height
+
+    resized, _ = resample(mask_np, (new_width, new_height), policy)
+    if (left, top, new_width, new_height) == (0, 0, width, height):
+        # Own the result; the input may be a view of a message buffer
+        return np.array(resized)
+    document = np.zeros((height, width), dtype=np.uint8)
+    paste(document, resized, left, top)
+    return document
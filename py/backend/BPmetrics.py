@@ -0,0 +1,180 @@
+"""In-process metrics served at `/ps/metrics` (Prometheus text) and `/ps/metrics.json`.
+
+Stdlib only, so ingest worker processes can import it; they cannot share
+the registry, though, and return their timings for the main process to
+record. Recording is a bisect and a few additions under a lock.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, from sub-millisecond message handling up to multi-second 8K layers
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Bytes, from control messages up to full-resolution layer frames
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456)
+
+
+class _HistogramSeries:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        # One slot per bucket plus the +Inf overflow
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._series: dict[tuple, object] = {}
+
+    def samples(self) -> list[tuple[tuple, object]]:
+        with self._lock:
+            return list(self._series.items())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A gauge whose values come from `collect()` at scrape time, or from `set`."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), collect=None):
+        super().__init__(name, help, labels)
+        self._collect = collect
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._series[labels] = value
+
+    def samples(self) -> list[tuple[tuple, object]]:
+        if self._collect is not None:
+            return list(self._collect().items())
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = _HistogramSeries(self.buckets)
+            series.counts[index] += 1
+            series.sum += value
+            series.count += 1
+
+    def samples(self) -> list[tuple[tuple, object]]:
+        # Copy under the lock so a scrape never sees a half-updated series
+        with self._lock:
+            return [(labels, (list(series.counts), series.sum, series.count)) for labels, series in self._series.items()]
+
+    @contextmanager
+    def time(self, *labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        # Modules may be reloaded; keep the first instance so recorded data survives
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple = (), collect=None) -> Gauge:
+        return self.register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for labels, value in metric.samples():
+                pairs = [f'{key}="{_escape(label)}"' for key, label in zip(metric.labels, labels)]
+                if metric.kind != "histogram":
+                    lines.append(f"{metric.name}{_labels(pairs)} {_number(value)}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else _number(bound)
+                    bucket_labels = _labels(pairs + [f'le="{le}"'])
+                    lines.append(f"{metric.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{metric.name}_sum{_labels(pairs)} {_number(total)}")
+                lines.append(f"{metric.name}_count{_labels(pairs)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict:
+        result = {}
+        for metric in self._metrics.values():
+            series = []
+            for labels, value in metric.samples():
+                entry = {"labels": dict(zip(metric.labels, labels))}
+                if metric.kind == "histogram":
+                    counts, total, count = value
+                    entry.update(count=count, sum=total, mean=total / count if count else 0, buckets=dict(zip([*map(str, metric.buckets), "+Inf"], counts)))
+                else:
+                    entry["value"] = value
+                series.append(entry)
+            result[metric.name] = {"type": metric.kind, "help": metric.help, "series": series}
+        return result
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(pairs: list[str]) -> str:
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = MetricsRegistry()
+
+stage_seconds = metrics.histogram("bluepixel_stage_seconds", "Time spent in each pipeline stage.", ("stage",))
+message_bytes = metrics.histogram("bluepixel_message_bytes", "Websocket message sizes.", ("direction", "platform"), SIZE_BUCKETS)
+bytes_sent = metrics.counter("bluepixel_bytes_sent_total", "Websocket payload bytes written to clients.", ("platform",))
+messages_dropped = metrics.counter("bluepixel_messages_dropped_total", "Outbound messages dropped or coalesced for slow clients.", ("platform", "reason"))
+
+
+def record_timings(timings: dict) -> None:
+    """Record stage timings measured elsewhere, e.g. in an ingest worker process."""
+    for stage, seconds in timings.items():
+        stage_seconds.observe(seconds, stage)
@@ -1,17 +1,19 @@
+import asyncio
+import time
 import base64
 import ipaddress
 import logging
-import aiofiles
 from aiohttp import web
 import folder_paths
 from server import PromptServer
 import os
 from BPutils import dirs
+from BPcodec import encode, find_image, read_array, sniff
 from urllib.parse import urlparse
 import re
-from BPclient import ws_manager
-import io
-from PIL import Image
+from BPclient import load_render, ws_manager
+from BPmetrics import metrics
+from BPcache import cache_stats
 
 # from BPclient import user_manager
 
@@ -25,11 +27,26 @@ async def get_workflow(request):
     return web.FileResponse(file)
 
 
+def png_preview(path: str) -> bytes:
+    return encode(read_array(path), "png")
+
+
 @PromptServer.instance.routes.get("/ps/inputs/{filename}")
 async def get_input(request):
-    file = os.path.abspath(os.path.join(dirs.psimg, request.match_info["filename"]))
+    filename = request.match_info["filename"]
+    # Previews come from the namespace the requesting ComfyUI tab's prompts read
+    directory = ws_manager.input_store(request.rel_url.query.get("cmUID", "")).persist_dir
+    if find_image(os.path.join(directory, os.path.splitext(filename)[0])) is None:
+        directory = dirs.psimg
+    file = os.path.abspath(os.path.join(directory, filename))
     if os.path.commonpath([file, dirs.psimg]) != dirs.psimg:
         return web.Response(status=403)
+    if not os.path.exists(file) and file.endswith(".png"):
+        # Node previews always ask for PNG; transcode copies stored as npy/zstd
+        stored = find_image(file[: -len(".png")])
+        if stored is not None and sniff(stored) != "png":
+            loop = asyncio.get_event_loop()
+            return web.Response(body=await loop.run_in_executor(None, png_preview, stored), content_type="image/png")
     return web.FileResponse(file)
 
 
@@ -44,6 +61,8 @@ async def get_error_image(request):
 
 @PromptServer.instance.routes.get("/ps/renderbatch")
 async def handle_render_batch(request):
+    # Kept for external callers; the Send to PS node delivers in-process
+    since = time.perf_counter()
     try:
         cmUID = request.rel_url.query.get("cmUID", "")
         filenames_param = request.rel_url.query.get("filenames", "")
@@ -54,51 +73,17 @@ async def handle_render_batch(request):
 
         temp_dir = folder_paths.get_temp_directory()
         batch_results = []
+        loop = asyncio.get_event_loop()
 
         for filename in filenames:
             try:
                 filepath = os.path.join(temp_dir, filename)
-
-                async with aiofiles.open(filepath, "rb") as image_file:
-                    file_content = await image_file.read()
-
-                image = Image.open(io.BytesIO(file_content)).convert("RGBA")
-                width, height = image.size
-
-                alpha_channel = image.getchannel("A")
-                bbox = alpha_channel.getbbox()
-
-                if not bbox:
-                    bbox = (0, 0, width, height)
-
-                source_bounds = {"left": bbox[0], "top": bbox[1], "right": bbox[2], "bottom": bbox[3]}
-
-                # Convert to Uint8Array
-                uint8_array = list(file_content)
-
-                batch_results.append({"image": uint8_array, "size": {"width": width, "height": height}, "sourceBounds": source_bounds, "filename": filename})
-
+                batch_results.append(await loop.run_in_executor(None, load_render, filepath, filename))
             except Exception as e:
                 print(f"# PS: Error processing file {filename}: {e}")
 
         if batch_results:
-            # Check if cmUID is provided
-            if cmUID and cmUID in ws_manager.clients:
-                # Get the IP address of the cm user
-                cm_ip = ws_manager.clients[cmUID].ip
-                # Filter ps users with the same IP address
-                ps_users_same_ip = [uid for uid in ws_manager.photoshop_users if uid in ws_manager.clients and ws_manager.clients[uid].ip == cm_ip]
-
-                if ps_users_same_ip:
-                    # Send message only to ps users with the same IP
-                    await ws_manager.send_message(ps_users_same_ip, "render_batch", batch_results)
-                    print(f"# PS: from {cmUID}, {len(filenames)} images sent to {len(ps_users_same_ip)}, IP: {cm_ip}")
-                else:
-                    print(f"# PS: No PS users found with the same IP as cmUID: {cmUID}, IP: {cm_ip}")
-            else:
-                # Fallback to sending to all PS users if cmUID is not provided or not found
-                await ws_manager.send_message(ws_manager.photoshop_users, "render_batch", batch_results)
-                print(f"# PS: Batch of {len(filenames)} images sent to all PS users. cmUID: {cmUID} was not found or not provided")
+            await ws_manager.deliver_renders(cmUID, batch_results, since)
 
     except Exception as e:
         print(f"# PS: Error in batch rendering: {e}")
@@ -107,6 +92,16 @@ async def handle_render_batch(request):
     return web.Response(text=f"Batch of {len(filenames)} images sent to ps with cmUID: {cmUID}")
 
 
+@PromptServer.instance.routes.get("/ps/metrics")
+async def get_metrics(request):
+    return web.Response(text=metrics.to_prometheus(), content_type="text/plain")
+
+
+@PromptServer.instance.routes.get("/ps/metrics.json")
+async def get_metrics_json(request):
+    return web.json_response({**metrics.to_dict(), "caches": cache_stats()})
+
+
 @PromptServer.instance.routes.get("/ps/icons/{filename}.svg")
 async def get_logo(request):
     filename = request.match_info["filename"] + ".svg"
@@ -1,50 +1,81 @@
+import asyncio
 import uuid
 import logging
 from aiohttp import web, WSMsgType
 from server import PromptServer
-from BPutils import LatestVer
-from BPclient import ws_manager, Client
+from BPutils import LatestVer, SERVER_FEATURES, parse_client_version, settings
+from BPclient import ws_manager, ingest_pool, Client
+from BPstore import layer_stores
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
 
+async def bind_loop(app: web.Application) -> None:
+    # Node code runs on executor threads and hands renders over through this loop
+    ws_manager.loop = asyncio.get_running_loop()
+
+
+async def start_ingest_pool(app: web.Application) -> None:
+    # Spawning and warming worker processes blocks, so keep it off the loop
+    await asyncio.get_event_loop().run_in_executor(None, ingest_pool.start)
+
+
+async def stop_ingest_pool(app: web.Application) -> None:
+    await asyncio.get_event_loop().run_in_executor(None, ingest_pool.shutdown)
+
+
+async def prune_namespaces(app: web.Application) -> None:
+    await asyncio.get_event_loop().run_in_executor(None, layer_stores.prune)
+
+
+PromptServer.instance.app.on_startup.append(bind_loop)
+PromptServer.instance.app.on_startup.append(prune_namespaces)
+PromptServer.instance.app.on_startup.append(start_ingest_pool)
+PromptServer.instance.app.on_cleanup.append(stop_ingest_pool)
+
+
 @PromptServer.instance.routes.get("/ps/ws")
 async def websocket_handler(request: web.Request) -> web.WebSocketResponse:
-    # Set a very high message size limit (e.g., 100 MB)
-    ws = web.WebSocketResponse(max_msg_size=500 * 1024 * 1024)  # 500 MB
-    await ws.prepare(request)
-
     client_id = request.query.get("clientId", str(uuid.uuid4()))
     platform = request.query.get("platform", "unknown")
-    version = request.query.get("version", "unknown")
-    
+    version, features = parse_client_version(request.query.get("version", "unknown"), request.query.get("features", ""))
+
+    # Plugins that stream large fields as chunked uploads never need huge frames;
+    # older ones send whole documents in one message
+    max_msg_size = settings.chunked_max_msg_bytes if "chunked" in features else 500 * 1024 * 1024  # 500 MB
+    ws = web.WebSocketResponse(max_msg_size=max_msg_size)
+    await ws.prepare(request)
+
     # Get client IP address
     peername = request.transport.get_extra_info('peername')
     client_ip = peername[0] if peername else "unknown"
-    
-    # Store client with IP address
-    ws_manager.clients[client_id] = Client(ws=ws, platform=platform, ip=client_ip)
-    
+    # Clients pair by IP unless both sides pass the same explicit key; the two
+    # kinds are tagged so an explicit key can never claim another client's IP
+    pair = request.query.get("pair")
+    pair_key = ("key", pair) if pair else ("ip", client_ip)
+
+    ws_manager.connect(Client(id=client_id, ws=ws, platform=platform, ip=client_ip, version=version, features=features, pair_key=pair_key))
+
     try:
         if platform == "ps":
-            ws_manager.photoshop_users.append(client_id)
             logger.info(f"Photoshop client {client_id} connected from IP: {client_ip}")
-            await ws_manager.send_message(ws_manager.photoshop_users, "latestVer", await LatestVer(version))
-            
-            # Notify only CM users with same IP
-            cm_users_same_ip = [uid for uid in ws_manager.comfyui_users if uid in ws_manager.clients and ws_manager.clients[uid].ip == client_ip]
-            await ws_manager.send_message(cm_users_same_ip, "psConnected")
+            await ws_manager.send_message(ws_manager.registry.ids("ps"), "latestVer", await LatestVer(version))
+            if features:
+                # Plugins that advertise features learn which ones this backend accepts
+                await ws_manager.send_message([client_id], "serverFeatures", list(SERVER_FEATURES))
+
+            # Notify only paired CM users
+            await ws_manager.send_message(ws_manager.route(client_id, "cm"), "psConnected")
 
         elif platform == "cm":
-            ws_manager.comfyui_users.append(client_id)
             logger.info(f"ComfyUI client {client_id} connected from IP: {client_ip}")
-            
-            # Only notify PS users with same IP if any exist
-            ps_users_same_ip = [uid for uid in ws_manager.photoshop_users if uid in ws_manager.clients and ws_manager.clients[uid].ip == client_ip]
-            if ps_users_same_ip:
+
+            # Only notify paired PS users if any exist
+            ps_peers = ws_manager.route(client_id, "ps")
+            if ps_peers:
                 await ws_manager.send_message([client_id], "psConnected")
-                await ws_manager.send_message(ps_users_same_ip, "cmConnected")
+                await ws_manager.send_message(ps_peers, "cmConnected")
 
         async for msg in ws:
             if msg.type == WSMsgType.TEXT:
@@ -65,6 +96,6 @@ async def websocket_handler(request: web.Request) -> web.WebSocketResponse:
         logger.error(f"Error in websocket handler: {e}")
 
     finally:
-        await ws_manager.handle_client_disconnect(client_id, platform)
+        await ws_manager.handle_client_disconnect(client_id, platform, ws)
 
     return ws
\ No newline at end of file
@@ -0,0 +1,332 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+from BPcodec import encode, find_image, resolve_format, write_image
+from BPmetrics import stage_seconds
+from BPutils import dirs, settings
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+
+MANIFEST_NAME = "manifest.json"
+# Namespace directories nobody has written to for this long are removed at startup
+STALE_NAMESPACE_AGE = 24 * 3600
+
+# One writer thread serves every store, so persistence never competes with itself
+_persist_executor = None
+_persist_executor_lock = threading.Lock()
+
+
+def persist_executor() -> ThreadPoolExecutor:
+    global _persist_executor
+    with _persist_executor_lock:
+        if _persist_executor is None:
+            _persist_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ps-persist")
+        return _persist_executor
+
+
+def content_digest(pixels: np.ndarray) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(pixels.shape).encode())
+    digest.update(np.ascontiguousarray(pixels).data)
+    return digest.hexdigest()
+
+
+class LayerEntry:
+    __slots__ = ("title", "version", "pixels", "digest", "writes")
+
+    def __init__(self, title: str, version: int, pixels: np.ndarray, digest: str):
+        self.title = title
+        self.version = version
+        self.pixels = pixels
+        self.digest = digest
+        # Odd while tiles are being written into `pixels`
+        self.writes = 0
+
+    @property
+    def size(self) -> tuple[int, int]:
+        return self.pixels.shape[1], self.pixels.shape[0]
+
+
+class LayerStore:
+    """Process-wide store of decoded uint8 layers, keyed by title and ingest version.
+
+    Ingest threads put arrays here and `PsImages` reads them directly, so the
+    files in `dirs.psimg` are only an asynchronous persistence copy for UI
+    previews and restarts, written in `settings.storage_format`.
+
+    Every layer carries a content digest computed once at ingest. Written
+    files are recorded with their digest, version, mtime and size in a small
+    manifest, so change detection never has to re-read or re-hash them.
+
+    Titles with an ingest in flight are marked pending (`ingesting`), and
+    readers can block until they are published (`wait_ready`) rather than
+    read a version that is about to be replaced.
+    """
+
+    def __init__(self, persist_dir: str, namespace: str = ""):
+        self._lock = threading.Lock()
+        self._layers: dict[str, LayerEntry] = {}
+        self._version = 0
+        self.namespace = namespace
+        self._persist_dir = persist_dir
+        self.storage_format = resolve_format(settings.storage_format)
+        self._persist_pending: dict[str, LayerEntry] = {}
+        # Ingests in flight per title; `_ready` is notified as each one finishes
+        self._ingesting: dict[str, int] = {}
+        self._ready = threading.Condition(self._lock)
+        # Monotonic time of the last put, for picking a namespace when a prompt names none
+        self.last_active = 0.0
+        self._manifest: dict[str, dict] = self._load_manifest()
+        # Keep versions monotonic across restarts
+        self._version = max((record["version"] for record in self._manifest.values()), default=0)
+
+    def put(self, title: str, pixels: np.ndarray) -> LayerEntry:
+        """Publish a layer. Hashes the pixels, so call it off the event loop."""
+        with stage_seconds.time("digest"):
+            digest = content_digest(pixels)
+        with self._lock:
+            self._version += 1
+            entry = LayerEntry(title, self._version, pixels, digest)
+            self._layers[title] = entry
+            self.last_active = time.monotonic()
+        if settings.persist_layers:
+            self._schedule_persist(entry)
+        return entry
+
+    def get(self, title: str) -> LayerEntry | None:
+        return self._layers.get(title)
+
+    def apply_tiles(self, title: str, base_version: int, tiles: list) -> LayerEntry | None:
+        """Write (left, top, width, height, pixels) tiles into a layer in place.
+
+        Returns None without touching the layer when it is unknown, its
+        version is not `base_version`, or a tile does not fit it.
+        """
+        with self._lock:
+            entry = self._layers.get(title)
+            if entry is None or entry.version != base_version:
+                return None
+            height, width, channels = entry.pixels.shape
+            for left, top, tile_width, tile_height, pixels in tiles:
+                if left < 0 or top < 0 or left + tile_width > width or top + tile_height > height:
+                    return None
+                if pixels.size != tile_width * tile_height * channels:
+                    return None
+            # Chain the digest over the tiles rather than re-hashing the whole layer
+            digest = hashlib.blake2b(entry.digest.encode(), digest_size=16)
+            entry.writes += 1
+            for left, top, tile_width, tile_height, pixels in tiles:
+                region = entry.pixels[top : top + tile_height, left : left + tile_width]
+                region[...] = pixels.reshape((tile_height, tile_width, channels))
+                digest.update(f"{left},{top},{tile_width},{tile_height}".encode())
+                digest.update(pixels.data)
+            self._version += 1
+            entry.version = self._version
+            entry.digest = digest.hexdigest()
+            entry.writes += 1
+            self.last_active = time.monotonic()
+        if settings.persist_layers:
+            self._schedule_persist(entry)
+        return entry
+
+    def read(self, title: str, convert):
+        """Return (version, digest, convert(pixels)) for a consistent view of a layer.
+
+        The version and digest are those of the pixels actually converted.
+        Tiles are applied in place, so a conversion that overlapped one is
+        repeated while holding off writers.
+        """
+        entry = self._layers.get(title)
+        if entry is None:
+            return None, None, None
+        writes = entry.writes
+        version, digest = entry.version, entry.digest
+        if writes % 2 == 0:
+            result = convert(entry.pixels)
+            if entry.writes == writes:
+                return version, digest, result
+        with self._lock:
+            return entry.version, entry.digest, convert(entry.pixels)
+
+    @contextmanager
+    def ingesting(self, titles):
+        """Mark `titles` pending for the duration of the block."""
+        titles = list(titles)
+        with self._lock:
+            for title in titles:
+                self._ingesting[title] = self._ingesting.get(title, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                for title in titles:
+                    if self._ingesting[title] > 1:
+                        self._ingesting[title] -= 1
+                    else:
+                        del self._ingesting[title]
+                self._ready.notify_all()
+
+    def wait_ready(self, title: str, timeout: float) -> bool:
+        """Block until no ingest of `title` is in flight; False on timeout."""
+        with self._ready:
+            return self._ready.wait_for(lambda: title not in self._ingesting, timeout)
+
+    @property
+    def persist_dir(self) -> str:
+        return self._persist_dir
+
+    def _schedule_persist(self, entry: LayerEntry) -> None:
+        with self._lock:
+            # A layer already waiting for the writer only needs its newest version saved
+            queued = entry.title in self._persist_pending
+            self._persist_pending[entry.title] = entry
+        if not queued:
+            persist_executor().submit(self._persist, entry.title)
+
+    def _persist(self, title: str) -> None:
+        with self._lock:
+            entry = self._persist_pending.pop(title, None)
+        if entry is None:
+            return
+        try:
+            writes, version, digest = entry.writes, entry.version, entry.digest
+            data = self.encode(entry.pixels)
+            if writes % 2 or entry.writes != writes:
+                # Tiles landed mid-encode and scheduled their own copy
+                return
+            path = self.write(title, data)
+            self._record(title, path, version, digest)
+        except Exception as e:
+            logger.error(f"❌ Error persisting layer ({title}): {e}", exc_info=True)
+
+    def encode(self, pixels: np.ndarray) -> bytes:
+        with stage_seconds.time(f"{self.storage_format}_encode"):
+            return encode(pixels, self.storage_format, settings.png_compress_level, settings.zstd_level)
+
+    def write(self, name: str, data: bytes) -> str:
+        os.makedirs(self._persist_dir, exist_ok=True)
+        with stage_seconds.time("save"):
+            return write_image(os.path.join(self._persist_dir, name), data, self.storage_format)
+
+    def change_key(self, name: str) -> str:
+        """Cheap identity for `IS_CHANGED`: the digest, else the file's mtime and size."""
+        entry = self._layers.get(name)
+        if entry is not None:
+            return entry.digest
+        path = find_image(os.path.join(self._persist_dir, name))
+        if path is None:
+            return "File not found"
+        stat = os.stat(path)
+        record = self._manifest.get(name)
+        if record and record["mtime"] == stat.st_mtime_ns and record["size"] == stat.st_size:
+            return record["digest"]
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def _record(self, name: str, path: str, version: int, digest: str) -> None:
+        stat = os.stat(path)
+        with self._lock:
+            self._manifest[name] = {"version": version, "digest": digest, "mtime": stat.st_mtime_ns, "size": stat.st_size}
+            manifest = json.dumps(self._manifest, ensure_ascii=False)
+        manifest_path = os.path.join(self._persist_dir, MANIFEST_NAME)
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as file:
+            file.write(manifest)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self._persist_dir, MANIFEST_NAME), encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def clear(self) -> None:
+        """Forget every layer and pending copy; files on disk are left alone."""
+        with self._lock:
+            self._layers.clear()
+            self._persist_pending.clear()
+
+
+def namespace_dir(namespace: str) -> str:
+    # Client ids come from the query string; keep them to one safe path component
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", namespace).strip(".") or "_"
+
+
+class LayerStores:
+    """Layer stores scoped per Photoshop client, so concurrent artists never
+    overwrite each other's layers or invalidate each other's cache entries.
+
+    Namespace "" is the shared store in `dirs.psimg` itself, used when
+    namespacing is off and for files placed there by hand; every other
+    namespace persists to a subdirectory named after it. Dropping a
+    namespace forgets its layers and deletes that directory.
+    """
+
+    def __init__(self, root: str):
+        self._lock = threading.Lock()
+        self._root = root
+        self.default = LayerStore(root)
+        self._stores: dict[str, LayerStore] = {}
+
+    def get(self, namespace: str) -> LayerStore:
+        if not namespace or not settings.namespaces:
+            return self.default
+        with self._lock:
+            store = self._stores.get(namespace)
+            if store is None:
+                store = self._stores[namespace] = LayerStore(os.path.join(self._root, namespace_dir(namespace)), namespace)
+            return store
+
+    def find(self, namespace: str) -> LayerStore | None:
+        return self._stores.get(namespace) if namespace else self.default
+
+    def resolve(self, candidates: list[str] | None) -> LayerStore:
+        """The most recently written store among `candidates` (every namespace
+        if None), or the shared store if none of them has received a layer.
+        """
+        stores = list(self._stores.values()) if candidates is None else [self._stores[name] for name in candidates if name in self._stores]
+        stores = [store for store in stores if store.last_active]
+        return max(stores, key=lambda store: store.last_active) if stores else self.default
+
+    def drop(self, namespace: str) -> None:
+        with self._lock:
+            store = self._stores.pop(namespace, None)
+        if store is None:
+            return
+        store.clear()
+        # Queued behind any copy still being written for it
+        persist_executor().submit(shutil.rmtree, store.persist_dir, True)
+        logger.info(f"🧹 Dropped layer namespace {namespace}")
+
+    def prune(self, max_age: float = STALE_NAMESPACE_AGE) -> None:
+        """Remove namespace directories left over from earlier runs."""
+        try:
+            names = os.listdir(self._root)
+        except OSError:
+            return
+        cutoff = time.time() - max_age
+        active = {namespace_dir(name) for name in self._stores}
+        for name in names:
+            path = os.path.join(self._root, name)
+            if name in active or not os.path.isdir(path):
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+
+layer_stores = LayerStores(dirs.psimg)
+layer_store = layer_stores.default
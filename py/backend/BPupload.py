@@ -0,0 +1,141 @@
+"""Chunked uploads for plugins that advertise the "chunked" feature.
+
+Instead of one huge websocket frame, a plugin streams each large binary
+field (layer pixels, tile data, mask data) as its own upload:
+
+    {"uploadBegin":  {"id": "u1", "size": 33554432}}
+    {"uploadChunk":  {"id": "u1", "offset": 0, "data": <bin>}}   (repeated, in order)
+    {"uploadEnd":    {"id": "u1"}}
+    {"uploadCancel": {"id": "u1"}}                                 (at any point)
+
+and then sends the usual `combinedData` message with `{"upload": "u1"}` in
+place of the bytes. Chunks are copied straight into a buffer allocated at
+`uploadBegin`: memory for large uploads, a spooled temporary file above
+`settings.upload_spool_bytes`. The finished buffer reaches the ingest code
+as a memoryview, so peak memory is about one chunk plus the upload itself.
+
+Each chunk must start where the previous one ended, so a completed upload
+is exactly covered. A client may hold at most `settings.upload_max_open`
+uploads, finished-but-unclaimed ones included.
+"""
+
+import logging
+import mmap
+import tempfile
+import time
+
+from BPutils import settings
+
+logger = logging.getLogger(__name__)
+
+
+class UploadError(Exception):
+    pass
+
+
+class Upload:
+    __slots__ = ("id", "size", "received", "complete", "started", "_buffer", "_file")
+
+    def __init__(self, upload_id: str, size: int):
+        self.id = upload_id
+        self.size = size
+        self.received = 0
+        self.complete = False
+        self.started = time.perf_counter()
+        self._file = None
+        if size > settings.upload_spool_bytes:
+            # Spool to disk so a huge document costs page cache, not heap
+            self._file = tempfile.TemporaryFile(prefix="bluepixel-upload-")
+            self._file.truncate(size)
+            self._buffer = mmap.mmap(self._file.fileno(), size)
+        else:
+            self._buffer = bytearray(size)
+
+    def write(self, offset: int, data: bytes) -> None:
+        if offset != self.received:
+            # Out-of-order or repeated chunks would leave gaps that reach ingest as zeros
+            raise UploadError(f"chunk at {offset} does not follow the {self.received} bytes received")
+        if offset + len(data) > self.size:
+            raise UploadError(f"chunk {offset}+{len(data)} is outside the {self.size} byte upload")
+        self._buffer[offset : offset + len(data)] = data
+        self.received += len(data)
+
+    def view(self) -> memoryview:
+        return memoryview(self._buffer)
+
+    def close(self) -> None:
+        buffer, self._buffer = self._buffer, None
+        if isinstance(buffer, mmap.mmap):
+            try:
+                buffer.close()
+            except BufferError:
+                # A view is still alive somewhere; the mapping goes when it does
+                pass
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class UploadManager:
+    """Uploads in flight and finished-but-unclaimed, per client."""
+
+    def __init__(self):
+        self._uploads: dict[tuple[str, str], Upload] = {}
+
+    def begin(self, client_id: str, upload_id: str, size: int) -> Upload:
+        size = int(size)
+        if size < 0 or size > settings.upload_max_bytes:
+            raise UploadError(f"upload size {size} exceeds the {settings.upload_max_bytes} byte limit")
+        self.cancel(client_id, upload_id)
+        held = sum(1 for key in self._uploads if key[0] == client_id)
+        if held >= settings.upload_max_open:
+            raise UploadError(f"client already holds {held} uploads (limit {settings.upload_max_open})")
+        upload = self._uploads[(client_id, upload_id)] = Upload(upload_id, size)
+        return upload
+
+    def chunk(self, client_id: str, upload_id: str, offset: int, data: bytes) -> None:
+        upload = self._uploads.get((client_id, upload_id))
+        if upload is None:
+            raise UploadError(f"unknown upload {upload_id}")
+        if upload.complete:
+            raise UploadError(f"upload {upload_id} is already complete")
+        upload.write(int(offset), data)
+
+    def end(self, client_id: str, upload_id: str) -> Upload:
+        upload = self._uploads.get((client_id, upload_id))
+        if upload is None:
+            raise UploadError(f"unknown upload {upload_id}")
+        if upload.received != upload.size:
+            self.cancel(client_id, upload_id)
+            raise UploadError(f"upload {upload_id} ended after {upload.received} of {upload.size} bytes")
+        upload.complete = True
+        return upload
+
+    def cancel(self, client_id: str, upload_id: str) -> bool:
+        upload = self._uploads.pop((client_id, upload_id), None)
+        if upload is None:
+            return False
+        upload.close()
+        return True
+
+    def discard_client(self, client_id: str) -> None:
+        for key in [key for key in self._uploads if key[0] == client_id]:
+            self._uploads.pop(key).close()
+
+    def resolve(self, client_id: str, value, claimed: list):
+        """Replace `{"upload": id}` references in a message with the upload's bytes.
+
+        Claimed uploads are appended to `claimed`; release them once the
+        message has been processed.
+        """
+        if isinstance(value, dict):
+            if len(value) == 1 and "upload" in value:
+                upload = self._uploads.pop((client_id, value["upload"]), None)
+                if upload is None or not upload.complete:
+                    raise UploadError(f"message references unfinished upload {value['upload']}")
+                claimed.append(upload)
+                return upload.view()
+            return {key: self.resolve(client_id, item, claimed) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.resolve(client_id, item, claimed) for item in value]
+        return value
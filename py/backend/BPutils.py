@@ -9,6 +9,7 @@ import io
 import os
 import aiohttp
 import math
+import re
 
 
 def calculate_dimensions(total_pixels):
@@ -32,6 +33,69 @@ class directories:
 dirs = directories()
 
 
+def env_flag(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in ("0", "false", "no", "off", "")
+
+
+class Settings:
+    """Backend tunables, read once from BLUEPIXEL_* environment variables."""
+
+    def __init__(self):
+        # Layers live in memory; the on-disk copy only feeds UI previews and restarts
+        self.persist_layers = env_flag("BLUEPIXEL_PERSIST_LAYERS", True)
+        # On-disk format for layers and SELECTION: "png", "npy" or "zstd" (see BPcodec)
+        self.storage_format = os.environ.get("BLUEPIXEL_STORAGE_FORMAT", "png").strip().lower()
+        self.png_compress_level = int(os.environ.get("BLUEPIXEL_PNG_COMPRESS_LEVEL", 1))
+        self.zstd_level = int(os.environ.get("BLUEPIXEL_ZSTD_LEVEL", 1))
+        # "thread" keeps ingest in-process; "process" moves raw layer decoding to worker processes
+        self.ingest_mode = os.environ.get("BLUEPIXEL_INGEST_MODE", "thread").strip().lower()
+        self.ingest_workers = int(os.environ.get("BLUEPIXEL_INGEST_WORKERS", min(4, os.cpu_count() or 1)))
+        # Filter for scaling layers into their bounds: "fast" (bilinear), "balanced" (bicubic) or "best" (Lanczos);
+        # exact integer downscales use a box reduce unless BLUEPIXEL_RESAMPLE_REDUCE is off
+        self.resample_quality = os.environ.get("BLUEPIXEL_RESAMPLE_QUALITY", "best").strip().lower()
+        self.resample_reduce = env_flag("BLUEPIXEL_RESAMPLE_REDUCE", True)
+        # Keep each Photoshop client's layers in its own namespace (a subdirectory of
+        # ps_inputs/imgs), dropped this many seconds after the client disconnects
+        self.namespaces = env_flag("BLUEPIXEL_NAMESPACES", True)
+        self.namespace_grace = float(os.environ.get("BLUEPIXEL_NAMESPACE_GRACE_S", 600))
+        # How long PsImages waits for a layer Photoshop is still sending before reading the current copy
+        self.ready_timeout = float(os.environ.get("BLUEPIXEL_READY_TIMEOUT_S", 30))
+        # Memory budget for finished PsImages tensors; 0 disables the cache
+        self.tensor_cache_bytes = int(float(os.environ.get("BLUEPIXEL_TENSOR_CACHE_MB", 1024)) * 1024 * 1024)
+        # Per-client outbound queue length and byte budget, and what to do when a client falls behind them
+        self.send_queue_limit = int(os.environ.get("BLUEPIXEL_SEND_QUEUE_LIMIT", 64))
+        self.send_queue_bytes = int(float(os.environ.get("BLUEPIXEL_SEND_QUEUE_MB", 512)) * 1024 * 1024)
+        self.slow_client_policy = os.environ.get("BLUEPIXEL_SLOW_CLIENT_POLICY", "coalesce").strip().lower()
+        # Chunked uploads: frame limit for plugins that use them, largest upload, when to spool to disk,
+        # and how many uploads one client may hold at once
+        self.chunked_max_msg_bytes = int(float(os.environ.get("BLUEPIXEL_CHUNKED_MAX_MSG_MB", 16)) * 1024 * 1024)
+        self.upload_max_bytes = int(float(os.environ.get("BLUEPIXEL_UPLOAD_MAX_MB", 2048)) * 1024 * 1024)
+        self.upload_spool_bytes = int(float(os.environ.get("BLUEPIXEL_UPLOAD_SPOOL_MB", 64)) * 1024 * 1024)
+        self.upload_max_open = int(os.environ.get("BLUEPIXEL_UPLOAD_MAX_OPEN", 16))
+        # Renders sent to Photoshop are encoded straight from the output tensor; the
+        # temp PNGs only feed the ComfyUI preview
+        self.render_png_compress_level = int(os.environ.get("BLUEPIXEL_RENDER_PNG_COMPRESS_LEVEL", 4))
+        self.render_preview = env_flag("BLUEPIXEL_RENDER_PREVIEW", True)
+        # Send only the visible region of renders to plugins that advertise "crop"
+        self.render_crop = env_flag("BLUEPIXEL_RENDER_CROP", True)
+
+
+settings = Settings()
+
+# Optional wire features this backend understands. Plugins opt in with the
+# `features` query parameter, e.g. `features=bin,crop`. The older suffix form
+# `version=2.1.0+bin` is still accepted; an unencoded "+" reaches us as a space.
+SERVER_FEATURES = ("bin", "delta", "chunked", "crop")
+
+
+def parse_client_version(version: str, features: str = "") -> tuple[str, frozenset]:
+    base, *suffixes = re.split(r"[+\s]+", version.strip())
+    return base, frozenset(feature for feature in (*suffixes, *re.split(r"[,\s]+", features)) if feature)
+
+
 def force_pull():
     try:
         import git
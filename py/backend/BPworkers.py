@@ -0,0 +1,128 @@
+"""Long-lived ingest worker pool.
+
+In "thread" mode layers are decoded on a persistent thread pool. In
+"process" mode raw layers are decoded in separate processes so PIL work does
+not compete with the ComfyUI executor for the GIL; pixels cross the process
+boundary through `multiprocessing.shared_memory` instead of being pickled.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from BPimage import ResamplePolicy, as_uint8, decode_layer, is_jpeg, raw_shape
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def _warm_up() -> int:
+    return os.getpid()
+
+
+def _decode_shared(image_info: dict, in_name: str, in_size: int, out_name: str, out_shape: tuple, policy: ResamplePolicy) -> dict:
+    """Worker-process side: decode from one shared block into another.
+
+    Returns the stage timings, since metrics only live in the main process.
+    """
+    timings = {}
+    in_shm = shared_memory.SharedMemory(name=in_name)
+    out_shm = shared_memory.SharedMemory(name=out_name)
+    try:
+        pixels = np.ndarray((in_size,), dtype=np.uint8, buffer=in_shm.buf)
+        out = np.ndarray(out_shape, dtype=np.uint8, buffer=out_shm.buf)
+        decode_layer({**image_info, "imageData": pixels}, out=out, timings=timings, policy=policy)
+        # Views must be gone before the mappings can be closed
+        del pixels, out
+    finally:
+        in_shm.close()
+        out_shm.close()
+    return timings
+
+
+class IngestPool:
+    def __init__(self, mode: str = "thread", size: int = 4, policy: ResamplePolicy = ResamplePolicy()):
+        self.mode = mode if mode in ("thread", "process") else "thread"
+        self.size = max(1, size)
+        self.policy = policy
+        self._threads = None
+        self._processes = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Create the executors and, in process mode, spawn and warm every worker."""
+        with self._lock:
+            self._start()
+
+    def _start(self) -> None:
+        # `_threads` is assigned last: callers treat it as "the pool is ready"
+        if self._threads is not None:
+            return
+        if self.mode == "process":
+            self._processes = ProcessPoolExecutor(max_workers=self.size, mp_context=multiprocessing.get_context("spawn"))
+            # Each submit spawns a worker while none is idle; waiting pays the import cost up front
+            for future in [self._processes.submit(_warm_up) for _ in range(self.size)]:
+                future.result()
+            logger.info(f"🚀 Ingest pool ready: {self.size} worker processes")
+        else:
+            logger.info(f"🚀 Ingest pool ready: {self.size} worker threads")
+        self._threads = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="ps-ingest")
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._shutdown()
+
+    def _shutdown(self) -> None:
+        if self._threads is not None:
+            self._threads.shutdown(wait=True, cancel_futures=True)
+            self._threads = None
+        if self._processes is not None:
+            self._processes.shutdown(wait=True, cancel_futures=True)
+            self._processes = None
+
+    async def decode(self, image_info, timings: dict | None = None) -> np.ndarray:
+        """Decode a changedImages `imageInfo` into a document-sized uint8 array.
+
+        Stage durations, including time spent crossing to a worker process,
+        are added to `timings` if given.
+        """
+        timings = {} if timings is None else timings
+        loop = asyncio.get_event_loop()
+        if self._threads is None:
+            # Normally done at server startup; never block the loop spawning workers
+            await loop.run_in_executor(None, self.start)
+        # JPEG layers are small and never resized, so they stay on the threads
+        if self.mode == "thread" or is_jpeg(image_info):
+            return await loop.run_in_executor(self._threads, decode_layer, image_info, None, timings, self.policy)
+
+        # The shared-memory copies are full-layer memcpys; keep them off the loop too
+        return await loop.run_in_executor(self._threads, self._decode_in_process, image_info, timings)
+
+    def _decode_in_process(self, image_info: dict, timings: dict) -> np.ndarray:
+        """Thread side of process mode: hand the layer to a worker through shared memory."""
+        start = time.perf_counter()
+        pixels = as_uint8(image_info["imageData"])
+        out_shape = raw_shape(image_info, pixels.size)
+        in_shm = shared_memory.SharedMemory(create=True, size=max(1, pixels.nbytes))
+        out_shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(out_shape))))
+        try:
+            np.ndarray(pixels.shape, dtype=np.uint8, buffer=in_shm.buf)[...] = pixels
+            meta = {key: value for key, value in image_info.items() if key != "imageData"}
+            timings["shm_copy_in"] = time.perf_counter() - start
+            timings.update(self._processes.submit(_decode_shared, meta, in_shm.name, pixels.size, out_shm.name, out_shape, self.policy).result())
+            start = time.perf_counter()
+            result = np.array(np.ndarray(out_shape, dtype=np.uint8, buffer=out_shm.buf))
+            timings["shm_copy_out"] = time.perf_counter() - start
+            return result
+        finally:
+            in_shm.close()
+            in_shm.unlink()
+            out_shm.close()
+            out_shm.unlink()
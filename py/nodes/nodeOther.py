@@ -1,4 +1,3 @@
-import hashlib
 import os
 import folder_paths
 from PIL import Image
@@ -9,8 +8,13 @@ import numpy as np
 from io import BytesIO
 import folder_paths
 import asyncio
-import time
-from PIL import Image, ImageOps, ImageSequence, ImageFile
+from PIL import Image, ImageOps, ImageSequence
+from BPstore import layer_store
+from BPclient import ws_manager
+from BPcodec import find_image, read_array, sniff
+from BPmetrics import stage_seconds
+from BPcache import LRUCache
+from BPutils import settings
 
 nodepath = os.path.join(folder_paths.get_folder_paths("custom_nodes")[0], "comfyui-photoshop")
 imgpath = os.path.join(nodepath, "data", "ps_inputs", "imgs")
@@ -50,13 +54,95 @@ class modelPass:
         return (model,)
 
 
-ImageFile.LOAD_TRUNCATED_IMAGES = True
+# Output formats PsImages can emit. float32 is ComfyUI's convention; the
+# others trade compatibility with some nodes for a smaller footprint at 8K
+IMAGE_DTYPES = {"float32": torch.float32, "float16": torch.float16}
+# dtype and the value of a fully opaque / fully selected pixel
+MASK_FORMATS = {"float32": (torch.float32, 1.0), "uint8": (torch.uint8, 255), "bool": (torch.bool, True)}
+MASK_ONES = dict(MASK_FORMATS.values())
+
+
+def full_mask(shape, mask_format="float32"):
+    dtype, one = MASK_FORMATS[mask_format]
+    return torch.full(shape, one, dtype=dtype)
+
+
+def mask_into(mask, values):
+    """Write uint8 coverage into a preallocated mask of any supported format."""
+    if mask.dtype == torch.bool:
+        # Half-selected pixels and above count as selected
+        torch.ge(values, 128, out=mask)
+    elif mask.dtype == torch.uint8:
+        mask.copy_(values)
+    else:
+        mask.copy_(values).div_(255.0)
+
+
+def resize_mask(mask, h, w):
+    # Nearest keeps coverage values exact; it has no bool kernel, so go through uint8
+    resized = torch.nn.functional.interpolate(mask.unsqueeze(1).to(torch.uint8) if mask.dtype == torch.bool else mask.unsqueeze(1), size=(h, w), mode='nearest').squeeze(1)
+    return resized.to(torch.bool) if mask.dtype == torch.bool else resized
+
+
+def fill_frame(pixels, image, mask):
+    """Convert HxWx3/4 uint8 pixels into preallocated image and mask slices.
+
+    One widening copy straight into `image`, scaled in place; alpha is
+    composited over white, matching how Photoshop shows the layer.
+    """
+    source = torch.from_numpy(pixels)
+    image.copy_(source[..., :3]).div_(255.0)
+    if source.shape[2] < 4:
+        mask.fill_(MASK_ONES[mask.dtype])
+        return
+    alpha = source[..., 3]
+    mask_into(mask, alpha)
+    weight = mask if mask.dtype == image.dtype else alpha.to(image.dtype).div_(255.0)
+    # rgb * a + (1 - a) == (rgb - 1) * a + 1
+    image.sub_(1.0).mul_(weight.unsqueeze(-1)).add_(1.0)
+
+
+def input_store(cmUID, name):
+    """The store holding `name` for prompts queued by `cmUID`.
+
+    Layers the namespace has never received, such as the bundled MAIN DOC
+    placeholder, fall back to the shared directory. If Photoshop is still
+    sending `name`, waits for it so the prompt sees the new version.
+    """
+    store = ws_manager.input_store(cmUID)
+    if not store.wait_ready(name, settings.ready_timeout):
+        print(f"⚠️ {name} is still being received after {settings.ready_timeout}s, using the current copy")
+    if store is not layer_store and store.change_key(name) == "File not found":
+        return layer_store
+    return store
+
+
+def tensors_nbytes(value) -> int:
+    return sum(item.element_size() * item.nelement() for item in value if isinstance(item, torch.Tensor))
+
+
+def private_copy(value):
+    # Torch has no read-only tensors; a downstream in-place edit must not reach the cached copy
+    return tuple(item.clone() if isinstance(item, torch.Tensor) else item for item in value)
+
+
+# Finished outputs keyed by the digest of the pixels they were converted from. Callers
+# always get their own copy: one memcpy, instead of re-decoding and converting the layer
+tensor_cache = LRUCache("psimages", settings.tensor_cache_bytes, tensors_nbytes)
 
 
 class PsImages:
     @classmethod
     def INPUT_TYPES(cls):
-        return {"required": {"ImageName": ("STRING", {"default": ""})}}
+        return {
+            "required": {"ImageName": ("STRING", {"default": ""})},
+            "optional": {
+                "precision": (list(IMAGE_DTYPES), {"default": "float32"}),
+                "mask_format": (list(MASK_FORMATS), {"default": "float32"}),
+                # Routing hint set by the frontend: which ComfyUI tab queued the prompt
+                "cmUID": ("STRING", {"default": ""}),
+            },
+        }
 
     RETURN_NAMES = ("RGB", "ALPHA", "SELECTION", "W", "H")
     RETURN_TYPES = ("IMAGE", "MASK", "MASK", "INT", "INT")
@@ -64,93 +150,142 @@ class PsImages:
     FUNCTION = "select_image"
     CATEGORY = "🔹BluePixel/ToolBar"
 
-    def load_image_with_retry(self, image_path):
-        """Synchronous image loading with retry logic"""
-        delay = 0.1
-        max_attempts = 5
-        for attempt in range(max_attempts):
-            try:
-                img = Image.open(image_path)
-                img.load()
-                return img
-            except (IOError, OSError, Image.DecompressionBombError) as e:
-                if attempt == max_attempts - 1:
-                    raise Exception(f"Failed to load image after {max_attempts} attempts: {e}")
-                time.sleep(delay)
-                delay *= 2
-
-    def select_image(self, ImageName):
+    @staticmethod
+    def load_image(image_path):
+        # Stored copies are renamed into place once complete, so a read never sees a partial file
+        img = Image.open(image_path)
+        img.load()
+        return img
+
+    def load_from_file(self, ImageName, output_image, output_mask, w, h, precision="float32", mask_format="float32", directory=imgpath):
+        image_path = find_image(os.path.join(directory, ImageName))
+        if image_path is None:
+            raise FileNotFoundError(f"No stored copy of {ImageName} in {directory}")
+        print(f"🔵 Loading image from: {image_path}")
+        if sniff(image_path) != "png":
+            output_image, output_mask = self.tensors_from_pixels(read_array(image_path), precision, mask_format)
+            h, w = output_image.shape[1:3]
+            return output_image, output_mask, w, h
+        img = self.load_image(image_path)
+        print(f"✅ Image loaded successfully: {img.size}, mode: {img.mode}")
+
+        images = masks = None
+        count = 0
+        for frame in ImageSequence.Iterator(img):
+            frame = ImageOps.exif_transpose(frame)
+            if frame.mode == "I":
+                frame = frame.point(lambda i: i * (1 / 255))
+
+            # Keep alpha for fill_frame to composite; everything else becomes RGB
+            if frame.mode == "LA":
+                frame = frame.convert("RGBA")
+            elif frame.mode not in ("RGB", "RGBA"):
+                frame = frame.convert("RGB")
+
+            # The first frame sets the size; the batch is allocated once for every frame
+            if images is None:
+                w, h = frame.size
+                frames = getattr(img, "n_frames", 1)
+                images = torch.empty((frames, h, w, 3), dtype=IMAGE_DTYPES[precision])
+                masks = torch.empty((frames, h, w), dtype=MASK_FORMATS[mask_format][0])
+
+            # Skip frames with mismatched dimensions
+            if frame.size != (w, h):
+                continue
+
+            fill_frame(np.array(frame), images[count], masks[count])
+            count += 1
+
+        if count:
+            output_image, output_mask = images[:count], masks[:count]
+
+        return output_image, output_mask, w, h
+
+    @staticmethod
+    def tensors_from_pixels(pixels, precision="float32", mask_format="float32"):
+        height, width = pixels.shape[:2]
+        image = torch.empty((1, height, width, 3), dtype=IMAGE_DTYPES[precision])
+        mask = torch.empty((1, height, width), dtype=MASK_FORMATS[mask_format][0])
+        fill_frame(pixels, image[0], mask[0])
+        return image, mask
+
+    @staticmethod
+    def mask_from_pixels(pixels, mask_format="float32"):
+        selection = pixels if pixels.ndim == 2 else pixels[..., 0]
+        mask = torch.empty((1, *selection.shape), dtype=MASK_FORMATS[mask_format][0])
+        mask_into(mask[0], torch.from_numpy(selection))
+        return mask
+
+    def load_selection_file(self, mask_format="float32", directory=imgpath):
+        selection_path = find_image(os.path.join(directory, "SELECTION"))
+        if sniff(selection_path) != "png":
+            return self.mask_from_pixels(np.array(read_array(selection_path)), mask_format)
+        selection_img = self.load_image(selection_path)
+        selection_mask = []
+        for frame in ImageSequence.Iterator(selection_img):
+            frame = ImageOps.exif_transpose(frame)
+            # Masks are stored as L; older copies may be RGB, whose red channel is the mask
+            selection = np.array(frame if frame.mode == "L" else frame.convert("RGB"))
+            selection_mask.append(self.mask_from_pixels(selection, mask_format))
+        return torch.cat(selection_mask, dim=0) if len(selection_mask) > 1 else selection_mask[0]
+
+    def select_image(self, ImageName, precision="float32", mask_format="float32", cmUID=""):
+        with stage_seconds.time("psimages_load"):
+            return self._select_image(ImageName, precision, mask_format, cmUID)
+
+    def _select_image(self, ImageName, precision="float32", mask_format="float32", cmUID=""):
         # Default values
         default_size = (24, 24)
-        output_image = torch.zeros((1, *default_size, 3), dtype=torch.float32)
-        output_mask = torch.ones((1, *default_size), dtype=torch.float32)
-        selection_mask = torch.ones((1, *default_size), dtype=torch.float32)
+        output_image = torch.zeros((1, *default_size, 3), dtype=IMAGE_DTYPES[precision])
+        output_mask = full_mask((1, *default_size), mask_format)
+        selection_mask = full_mask((1, *default_size), mask_format)
         w, h = default_size
 
         try:
-            # Process main image
-            image_path = os.path.join(imgpath, ImageName + ".png")
-            print(f"🔵 Loading image from: {image_path}")
-            img = self.load_image_with_retry(image_path)
-            print(f"✅ Image loaded successfully: {img.size}, mode: {img.mode}")
-
-            output_images = []
-            output_masks = []
-
-            for frame in ImageSequence.Iterator(img):
-                frame = ImageOps.exif_transpose(frame)
-                if frame.mode == "I":
-                    frame = frame.point(lambda i: i * (1 / 255))
-
-                # Alpha handling
-                if frame.mode in ("RGBA", "LA"):
-                    alpha = frame.split()[-1]
-                    mask = np.array(alpha).astype(np.float32) / 255.0
-                    # Create a white background
-                    background = Image.new("RGB", frame.size, (255, 255, 255))
-                    # Paste the image onto the white background using the alpha channel as a mask
-                    background.paste(frame, mask=alpha)
-                    frame = background
+            # Process main image: cached tensors first, then the decoded copy kept by the ingest path
+            store = input_store(cmUID, ImageName)
+            image_key = ("image", store.namespace, ImageName, precision, mask_format)
+            cached = tensor_cache.get((*image_key, store.change_key(ImageName)))
+            if cached is not None:
+                output_image, output_mask, w, h = private_copy(cached)
+            else:
+                version, digest, tensors = store.read(ImageName, lambda pixels: self.tensors_from_pixels(pixels, precision, mask_format))
+                if tensors is not None:
+                    output_image, output_mask = tensors
+                    h, w = output_image.shape[1:3]
+                    print(f"✅ Image read from layer store: {ImageName} v{version} ({w}, {h})")
                 else:
-                    mask = np.ones((frame.height, frame.width), dtype=np.float32)
-
-                # Convert to RGB
-                if frame.mode != "RGB":
-                    frame = frame.convert("RGB")
-
-                # Get dimensions from first frame
-                if not output_images:
-                    w, h = frame.size
-
-                # Skip frames with mismatched dimensions
-                if frame.size != (w, h):
-                    continue
-
-                # Convert to tensors
-                image_tensor = torch.from_numpy(np.array(frame).astype(np.float32) / 255.0).unsqueeze(0)
-                mask_tensor = torch.from_numpy(mask).unsqueeze(0)
-
-                output_images.append(image_tensor)
-                output_masks.append(mask_tensor)
-
-            # Combine frames
-            if output_images:
-                output_image = torch.cat(output_images, dim=0) if len(output_images) > 1 else output_images[0]
-                output_mask = torch.cat(output_masks, dim=0) if len(output_masks) > 1 else output_masks[0]
-
-            # Process SELECTION.png
+                    digest = store.change_key(ImageName)
+                    output_image, output_mask, w, h = self.load_from_file(ImageName, output_image, output_mask, w, h, precision, mask_format, store.persist_dir)
+                    if store.change_key(ImageName) != digest:
+                        # Replaced while loading; the key could belong to either copy
+                        digest = None
+                # Placeholders for a missing layer are cheap to rebuild and would linger in the cache
+                if digest not in (None, "File not found"):
+                    cached = (output_image, output_mask, w, h)
+                    if tensor_cache.put((*image_key, digest), cached):
+                        output_image, output_mask, w, h = private_copy(cached)
+
+            # Process SELECTION, preferring the document-sized uint8 mask kept by the ingest path
             try:
-                selection_img = self.load_image_with_retry(os.path.join(imgpath, "SELECTION.png"))
-                selection_mask = []
-                for frame in ImageSequence.Iterator(selection_img):
-                    frame = ImageOps.exif_transpose(frame).convert("RGB")
-                    red_channel = np.array(frame)[:, :, 0].astype(np.float32) / 255.0
-                    selection_mask.append(torch.from_numpy(red_channel).unsqueeze(0))
-
-                selection_mask = torch.cat(selection_mask, dim=0) if len(selection_mask) > 1 else selection_mask[0]
-                if h and w: selection_mask = torch.nn.functional.interpolate(selection_mask.unsqueeze(1), size=(h, w), mode='nearest').squeeze(1)
+                selection_store = input_store(cmUID, "SELECTION")
+                selection_key = ("selection", selection_store.namespace, h, w, mask_format)
+                cached = tensor_cache.get((*selection_key, selection_store.change_key("SELECTION")))
+                if cached is None:
+                    _, digest, selection_mask = selection_store.read("SELECTION", lambda pixels: self.mask_from_pixels(pixels, mask_format))
+                    if selection_mask is None:
+                        digest = selection_store.change_key("SELECTION")
+                        selection_mask = self.load_selection_file(mask_format, selection_store.persist_dir)
+                        if selection_store.change_key("SELECTION") != digest:
+                            digest = None
+                    if h and w and selection_mask.shape[1:] != (h, w):
+                        selection_mask = resize_mask(selection_mask, h, w)
+                    if digest is not None and tensor_cache.put((*selection_key, digest), (selection_mask,)):
+                        selection_mask = selection_mask.clone()
+                else:
+                    selection_mask = cached[0].clone()
             except:
-                selection_mask = torch.ones((1, h, w), dtype=torch.float32) if w and h else torch.ones((1, *default_size), dtype=torch.float32)
+                selection_mask = full_mask((1, h, w) if w and h else (1, *default_size), mask_format)
             
             output_mask = output_mask[:, :h, :w] if output_mask.shape[1:] != (h, w) else output_mask
             selection_mask = selection_mask[:, :h, :w] if selection_mask.shape[1:] != (h, w) else selection_mask
@@ -164,18 +299,14 @@ class PsImages:
         return (output_image, output_mask, selection_mask, w, h)
 
     @classmethod
-    def IS_CHANGED(cls, ImageName):
-        img = os.path.join(imgpath, ImageName + ".png")
-        if not os.path.exists(img): return "File not found"
-        
-        with open(img, "rb") as f: img_hash = hashlib.sha256(f.read()).hexdigest()
-        
+    def IS_CHANGED(cls, ImageName, cmUID="", **kwargs):
+        # Digests are computed once at ingest, so this is a lookup rather than a re-hash
+        store = input_store(cmUID, ImageName)
+        key = f"{store.namespace}|{store.change_key(ImageName)}"
         if ImageName == "MAIN DOC":
-            sel = os.path.join(imgpath, "SELECTION.png")
-            if os.path.exists(sel):
-                with open(sel, "rb") as f: sel_hash = hashlib.sha256(f.read()).hexdigest()
-                return hashlib.sha256((img_hash + sel_hash).encode()).hexdigest()
-        return img_hash
+            selection_store = input_store(cmUID, "SELECTION")
+            return f"{key}|{selection_store.namespace}|{selection_store.change_key('SELECTION')}"
+        return key
 
 
 class PsString:
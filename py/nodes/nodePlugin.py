@@ -1,10 +1,11 @@
 from nodes import SaveImage
-import asyncio
 import os
+import time
 import torch
 import folder_paths
 import torch.nn.functional as F
-import aiohttp
+from BPclient import remember_render, ws_manager
+from BPutils import settings
 
 
 nodepath = os.path.join(folder_paths.get_folder_paths("custom_nodes")[0], "comfyui-photoshop")
@@ -45,76 +46,84 @@ class ComfyUIToPhotoshop(SaveImage):
     FUNCTION = "execute"
     CATEGORY = "🔹BluePixel"
 
-    async def connect_to_backend(self, filenames, cmUID):
+    @staticmethod
+    def visible_bounds(pixels: torch.Tensor) -> list[dict]:
+        """sourceBounds of the non-transparent pixels of each uint8 (N, H, W, C) image."""
+        count, height, width, channels = pixels.shape
+        if channels < 4:
+            return [{"left": 0, "top": 0, "right": width, "bottom": height}] * count
+        visible = pixels[..., 3] > 0
+        rows = visible.any(dim=2).to(torch.uint8)
+        cols = visible.any(dim=1).to(torch.uint8)
+        # argmax finds the first visible row/column from each side
+        top, left = rows.argmax(dim=1).tolist(), cols.argmax(dim=1).tolist()
+        bottom = (height - rows.flip(1).argmax(dim=1)).tolist()
+        right = (width - cols.flip(1).argmax(dim=1)).tolist()
+        bounds = []
+        for index, any_visible in enumerate(rows.any(dim=1).tolist()):
+            if any_visible:
+                bounds.append({"left": left[index], "top": top[index], "right": right[index], "bottom": bottom[index]})
+            else:
+                bounds.append({"left": 0, "top": 0, "right": width, "bottom": height})
+        return bounds
+
+    def send_to_ps(self, images: torch.Tensor, cmUID) -> list[dict] | None:
+        # Quantize like SaveImage, then hand off; PNG encoding and delivery run on the server side
+        since = time.perf_counter()
         try:
-            async with aiohttp.ClientSession() as session:
-                filenames_param = ",".join(filenames)
-                from server import PromptServer
-
-                server = PromptServer.instance
-                host = server.address
-                # Use localhost instead of 0.0.0.0 to avoid connection issues
-                if host == "0.0.0.0":
-                    host = "127.0.0.1"
-                port = server.port
-                url = f"http://{host}:{port}/ps/renderbatch?cmUID={cmUID}&filenames={filenames_param}"
-                async with session.get(url) as response:
-                    await response.text()
+            pixels = (images * 255.0).clamp_(0, 255).to(torch.uint8)
+            bounds = self.visible_bounds(pixels)
+            pixels = pixels.cpu().numpy()
+            renders = [(pixels[index], bounds[index], f"render_{index}.png") for index in range(len(bounds))]
+            ws_manager.deliver_pixels_threadsafe(cmUID, renders, since)
+            return bounds
         except Exception as e:
             print(f"_PS_ error on send2Ps: {e}")
+            return None
+
+    def preview(self, images, filename_prefix, prompt, extra_pnginfo, bounds=None):
+        if not settings.render_preview:
+            return {"ui": {"images": []}}
+        x = self.save_images(images, filename_prefix, prompt, extra_pnginfo)
+        if bounds:
+            # /ps/renderbatch callers get the bounds without decoding the files again
+            height, width = images.shape[1:3]
+            for img, source_bounds in zip(x["ui"]["images"], bounds):
+                remember_render(os.path.join(self.output_dir, img["subfolder"], img["filename"]), {"width": width, "height": height}, source_bounds)
+        return x
 
-    def execute(self, RGB: torch.Tensor, ALPHA: torch.Tensor = None, filename_prefix="PS_OUTPUTS", prompt=None, extra_pnginfo=None, cmUID: str = ""):
-
-        RGB_output = RGB.clone()
+    @staticmethod
+    def batch_alpha(ALPHA: torch.Tensor, count: int, height: int, width: int) -> torch.Tensor:
+        """Masks for the first `count` images as (M, H, W), M <= count; the last one covers the rest."""
+        alpha = ALPHA
+        if alpha.dim() == 2:
+            alpha = alpha.unsqueeze(0)
+        elif alpha.dim() == 4 and alpha.shape[1] == 1:
+            alpha = alpha.squeeze(1)
+        # Masks past the image count are never used, so never resize them
+        alpha = alpha[:count]
+        if alpha.shape[1:] != (height, width):
+            alpha = F.interpolate(alpha.unsqueeze(1), size=(height, width), mode="bilinear", align_corners=False).squeeze(1)
+        return alpha
 
+    def execute(self, RGB: torch.Tensor, ALPHA: torch.Tensor = None, filename_prefix="PS_OUTPUTS", prompt=None, extra_pnginfo=None, cmUID: str = ""):
         if ALPHA is not None:
-            rgb_batch_size = RGB.shape[0]
-            alpha_batch_size = ALPHA.shape[0] if ALPHA.dim() >= 3 else 1
-
-            processed_alpha = []
-
-            for i in range(rgb_batch_size):
-
-                alpha_idx = min(i, alpha_batch_size - 1)
-                current_alpha = ALPHA[alpha_idx] if ALPHA.dim() >= 3 else ALPHA
-
-                if current_alpha.dim() == 2:
-                    pass
-                elif current_alpha.dim() == 3 and current_alpha.shape[0] == 1:
-                    current_alpha = current_alpha.squeeze(0)
-
-                if current_alpha.shape != RGB[i].shape[:2]:
-                    current_alpha = current_alpha.unsqueeze(0).unsqueeze(0)
-                    current_alpha = F.interpolate(current_alpha, size=(RGB[i].shape[0], RGB[i].shape[1]), mode="bilinear", align_corners=False)
-                    current_alpha = current_alpha.squeeze(0).squeeze(0)
-
-                processed_alpha.append(current_alpha)
-
-            processed_alpha = torch.stack(processed_alpha)
-            processed_alpha = processed_alpha.unsqueeze(-1)
-
-            RGB_with_alpha = torch.cat((RGB, processed_alpha), dim=-1)
-            x = self.save_images(RGB_with_alpha, filename_prefix, prompt, extra_pnginfo)
+            count, height, width = RGB.shape[:3]
+            alpha = self.batch_alpha(ALPHA.to(RGB.device), count, height, width)
+
+            # Fill one preallocated RGBA batch instead of stacking and concatenating copies
+            output = torch.empty((count, height, width, 4), dtype=RGB.dtype, device=RGB.device)
+            output[..., :3] = RGB
+            output[: len(alpha), ..., 3] = alpha
+            if len(alpha) < count:
+                output[len(alpha) :, ..., 3] = alpha[-1]
         else:
-            x = self.save_images(RGB_output, filename_prefix, prompt, extra_pnginfo)
-
-        filenames = [img["filename"] for img in x["ui"]["images"]]
-        
-        # Use thread pool to run async code without blocking
-        import concurrent.futures
-        import threading
-        
-        def send_in_thread():
-            try:
-                import asyncio
-                asyncio.run(self.connect_to_backend(filenames, cmUID))
-            except Exception as e:
-                print(f"Error sending to PS: {e}")
-        
-        thread = threading.Thread(target=send_in_thread, daemon=True)
-        thread.start()
+            # Nothing downstream writes to the images, so RGB is used as is
+            output = RGB
 
-        return x
+        bounds = self.send_to_ps(output, cmUID)
+        # The preview is written after the hand-off so disk speed never delays the render
+        return self.preview(output, filename_prefix, prompt, extra_pnginfo, bounds)
 
 
 NODE_CLASS_MAPPINGS = {"🔹Photoshop ComfyUI Plugin": PhotoshopToComfyUI, "🔹SendTo Photoshop Plugin": ComfyUIToPhotoshop}
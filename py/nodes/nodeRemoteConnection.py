@@ -4,7 +4,6 @@ import torch
 import tempfile
 import os
 import base64
-import subprocess
 
 
 class PhotoshopConnections:
@@ -27,10 +26,12 @@ class PhotoshopConnections:
     def PS_Execute(self, Selection_To_Mask, password, Server, port):
         try:
             from photoshop import PhotoshopConnection
-        except:
-            subprocess.run(["python", "-m", "pip", "uninstall", "photoshop"], check=True)
-            subprocess.run(["python", "-m", "pip", "uninstall", "photoshop-connection"], check=True)
-            subprocess.run(["python", "-m", "pip", "install", "photoshop-connection"], check=True)
+        except ImportError as e:
+            # Installing packages mid-prompt can break the running server; leave it to the user
+            raise RuntimeError(
+                "This node needs the `photoshop-connection` package (which provides the `photoshop` module). "
+                "Install it with `python -m pip install photoshop-connection`, uninstalling any unrelated `photoshop` package first, then restart ComfyUI."
+            ) from e
 
         self.TmpDir = tempfile.gettempdir().replace("\\", "/")
         self.ImgDir = f"{self.TmpDir}/temp_image.jpg"
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import bench_suite  # noqa: E402
+
+# The backend imports ComfyUI modules; reuse the benchmark's stand-ins for them
+bench_suite._install_comfy_stubs(tempfile.mkdtemp(prefix="bp-tests-"))
+sys.path.insert(0, os.path.join(ROOT, "py", "backend"))
@@ -0,0 +1,44 @@
+import asyncio
+
+from aiohttp import ClientSession, web
+from yarl import URL
+
+from BPutils import parse_client_version
+
+
+async def parse_over_http(query: str) -> list:
+    """Send `query` unencoded, as the plugin does, and parse what the server decodes."""
+
+    async def handler(request):
+        version, features = parse_client_version(request.query.get("version", "unknown"), request.query.get("features", ""))
+        return web.json_response([version, sorted(features)])
+
+    app = web.Application()
+    app.router.add_get("/ps/ws", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        async with ClientSession() as session:
+            async with session.get(URL(f"http://127.0.0.1:{port}/ps/ws?{query}", encoded=True)) as response:
+                return await response.json()
+    finally:
+        await runner.cleanup()
+
+
+def test_literal_plus_in_version():
+    assert asyncio.run(parse_over_http("platform=ps&version=2.1.0+bin+crop")) == ["2.1.0", ["bin", "crop"]]
+
+
+def test_encoded_plus_in_version():
+    assert asyncio.run(parse_over_http("platform=ps&version=2.1.0%2Bchunked")) == ["2.1.0", ["chunked"]]
+
+
+def test_features_parameter():
+    assert asyncio.run(parse_over_http("platform=ps&version=2.1.0&features=bin,delta")) == ["2.1.0", ["bin", "delta"]]
+
+
+def test_plain_version():
+    assert parse_client_version("2.1.0") == ("2.1.0", frozenset())